@@ -0,0 +1,447 @@
+"""
+Micro-benchmarks for the inventory import and lead hot paths.
+
+They need a configured Django project, e.g.
+
+    python manage.py shell -c "from inventory import benchmarks; benchmarks.run()"
+
+The query plan and query count checks also run in the test suite:
+
+    python manage.py test inventory
+"""
+import csv
+import json
+import os
+import random
+import re
+import tempfile
+import timeit
+import tracemalloc
+from datetime import date, timedelta
+from time import perf_counter
+
+from django.core import mail
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import override_settings
+from lxml import etree
+
+from .models import *
+from .views import *
+
+# makes and their models in the synthetic inventory
+SAMPLE_MAKES = (
+    ('Acura', ('TLX', 'ILX', 'RDX', 'MDX')),
+    ('Honda', ('Accord', 'Civic', 'CR-V')),
+    ('Toyota', ('Camry', 'Corolla', 'RAV4')),
+    ('Ford', ('F-150', 'Escape')),
+    ('Nissan', ('Altima', 'Rogue')),
+    ('BMW', ('328i', 'X3')),
+)
+# days back the DateInStock of sample rows is spread over
+SAMPLE_STOCK_DAYS = 730
+
+# params:
+# 1. index: <Int> used to keep stock numbers and VINs unique
+# returns:
+# <Dict> a feed row with every column the importer knows about. Make,
+# model, type, certification, price and stock date are spread the way a
+# dealer group's feed is, seeded by index so runs are repeatable.
+def sample_feed_row(index=0):
+    rng = random.Random(index)
+    make, model_names = rng.choice(SAMPLE_MAKES)
+    model = rng.choice(model_names)
+    is_new = rng.random() < 0.5
+    certified = not is_new and rng.random() < 0.2
+    date_in_stock = date.today() - timedelta(days=rng.randrange(SAMPLE_STOCK_DAYS))
+    row = {}
+    for key, field_name in CSV_TO_MODEL_FIELD_MAP.items():
+        if field_name in Vehicle.INT_FIELDS:
+            row[key] = str(20000 + index % 5000)
+        elif field_name in Vehicle.FLOAT_FIELDS:
+            row[key] = '110.5'
+        else:
+            # cut to the column, which PostgreSQL enforces and SQLite doesn't
+            row[key] = key.lower()[:Vehicle._meta.get_field(field_name).max_length]
+    row.update({
+        'Stock': 'A%05d' % index,
+        'VIN': '19UUA8F2%09d' % index,
+        'Type': 'New' if is_new else 'Used',
+        'Certified': 'True' if certified else 'False',
+        'Make': make,
+        'Model': model,
+        'ModelNumber': (make + model).upper()[:8],
+        'MSRP': str(rng.randrange(18000, 60000)),
+        'Body': 'Sedan',
+        'Doors': '4',
+        'EngineDisplacement': '2.4L',
+        'DateInStock': date_in_stock.strftime('%m/%d/%Y'),
+        'ImageList': 'http://example.com/1.jpg,http://example.com/2.jpg',
+        'DealerName': 'Montclair Acura',
+    })
+    return row
+
+# params:
+# 1. rows: <Int> number of sample rows coerced per run
+# 2. repeat: <Int> runs of each variant, the best one is reported
+# returns:
+# <Dict> best seconds per row for the per-cell path and the compiled plan
+def bench_row_coercion(rows=1000, repeat=5):
+    sample = [sample_feed_row(i) for i in range(rows)]
+    plan = column_plan(CSV_TO_MODEL_FIELD_MAP, sample[0])
+
+    def per_cell():
+        for row in sample:
+            vehicle_from_csv_row(CSV_TO_MODEL_FIELD_MAP, row)
+
+    def compiled_to_dict():
+        for row in sample:
+            plan(row)
+
+    def compiled_to_vehicle():
+        for row in sample:
+            Vehicle(**plan(row))
+
+    results = {}
+    for name, func in (('per_cell', per_cell),
+                       ('compiled_to_dict', compiled_to_dict),
+                       ('compiled_to_vehicle', compiled_to_vehicle)):
+        results[name] = min(timeit.repeat(func, number=1, repeat=repeat)) / rows
+    return results
+
+# params:
+# 1. rows: <Int> sample rows in the feed
+# returns:
+# <String> path of a temporary csv feed; the caller removes it
+def write_sample_feed(rows):
+    handle, path = tempfile.mkstemp(suffix='.csv')
+    with os.fdopen(handle, 'w', newline='') as feed:
+        writer = None
+        for index in range(rows):
+            row = sample_feed_row(index)
+            if writer is None:
+                writer = csv.DictWriter(feed, fieldnames=list(row))
+                writer.writeheader()
+            writer.writerow(row)
+    return path
+
+# params:
+# 1. rows: <Int> sample rows in the feed
+# 2. workers: <Tuple> ingest_feed workers settings to compare, None being
+#    the single process pipeline
+# returns:
+# <Dict> rows per second, keyed by workers, for the coerce stage alone
+# ('coerce') and for the whole import ('ingest'), which is rolled back
+def bench_parallel_ingest(rows=20000, workers=(None, 2, 4, 8)):
+    path = write_sample_feed(rows)
+    results = {}
+    try:
+        for count in workers:
+            if count is None:
+                pipeline = FeedPipeline()
+            else:
+                pipeline = ProcessFeedPipeline(workers=count)
+            started = perf_counter()
+            for pair in pipeline.coerce(pipeline.map_headers(pipeline.read(path))):
+                pass
+            coerce_rate = rows / (perf_counter() - started)
+
+            with transaction.atomic():
+                stats = ingest_feed(path, workers=count)
+                transaction.set_rollback(True)
+            results[count] = {'coerce': coerce_rate, 'ingest': stats['rows_per_sec']}
+    finally:
+        os.remove(path)
+    return results
+
+# params:
+# 1. size: <Int> vehicles in the synthetic inventory
+# 2. lookups: <Int> vehicles looked up
+# returns:
+# <Dict> seconds per lookup for SimilarVehicleIndex and for a full scan,
+# which is how the database answers the unindexed msrp range
+def bench_similar_vehicles(size=50000, lookups=1000):
+    rng = random.Random(42)
+    rows = [(pk, rng.randrange(15000, 80000), rng.randrange(1, 400)) for pk in range(1, size + 1)]
+    is_new = dict((pk, pk % 2 == 0) for pk, msrp, model_id in rows)
+    index = SimilarVehicleIndex(rows)
+    sample = rng.sample(rows, lookups)
+
+    def scan(pk, msrp, model_id):
+        window = SimilarVehicleIndex.LOOKUP_WINDOW
+        if is_new[pk]:
+            ids = [other for other, o_msrp, o_model in rows if o_model == model_id and other != pk]
+            if ids:
+                return ids[:6]
+        return [other for other, o_msrp, o_model in rows
+                if abs(o_msrp - msrp) <= window and other != pk][:6]
+
+    for pk, msrp, model_id in sample[:50]:
+        assert index.similar_ids(pk, is_new[pk], model_id, msrp) == scan(pk, msrp, model_id)
+
+    started = perf_counter()
+    for pk, msrp, model_id in sample:
+        index.similar_ids(pk, is_new[pk], model_id, msrp)
+    indexed = (perf_counter() - started) / lookups
+
+    started = perf_counter()
+    for pk, msrp, model_id in sample[:50]:
+        scan(pk, msrp, model_id)
+    scanned = (perf_counter() - started) / 50
+    return {'index': indexed, 'scan': scanned}
+
+# params:
+# 1. func: callable taking no arguments
+# returns:
+# <Int> number of database queries func ran
+def count_queries(func):
+    with CaptureQueriesContext(connection) as queries:
+        func()
+    return len(queries)
+
+# Guards the listing serializer against N+1 regressions; needs a
+# database with a page worth of vehicles in it.
+# returns:
+# <List> of (manager method, queries) that ran more than two queries
+def check_listing_queries(page_size=60):
+    failures = []
+    for name in ('all', 'new', 'used', 'dch_certified', 'acura_certified',
+            'specials', 'used_specials', 'new_specials'):
+        queryset = getattr(Vehicle.objects, name)()[:page_size]
+        queries = count_queries(lambda: handlebars_dicts(queryset))
+        if queries > 2:
+            failures.append((name, queries))
+    return failures
+
+# params:
+# 1. size: <Int> vehicles written through the bulk importer
+def seed_inventory(size=50000):
+    rows = (sample_feed_row(i) for i in range(size))
+    stats = bulk_import_csv_rows(rows)
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+    return stats
+
+# The lookups the site runs on every listing, detail and send-to-mobile
+# page, as (name, queryset, selective). Only selective lookups match few
+# enough rows that a full scan means a missing index; for the listings a
+# scan that stops after a page of matches is a fine plan.
+def vehicle_lookups():
+    return (
+        ('new', Vehicle.objects.new()[:60], False),
+        ('used', Vehicle.objects.used()[:60], False),
+        ('dch_certified', Vehicle.objects.dch_certified()[:60], False),
+        ('acura_certified', Vehicle.objects.acura_certified(), True),
+        ('specials', Vehicle.objects.specials()[:60], False),
+        ('used_specials', Vehicle.objects.used_specials()[:60], False),
+        ('new_specials', Vehicle.objects.new_specials()[:60], False),
+        ('msrp_window', Vehicle.objects.filter(msrp__gte=24950, msrp__lte=25050), True),
+        ('stock_number', Vehicle.objects.filter(stock_number='A00042'), True),
+    )
+
+def explain(queryset):
+    sql, params = queryset.query.sql_with_params()
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        return '\n'.join(' '.join(str(col) for col in row) for row in cursor.fetchall())
+
+def is_full_scan(plan, table):
+    # the table name must end at a word boundary, or a scan of
+    # inventory_vehiclemake would count as one of inventory_vehicle
+    if connection.vendor == 'postgresql':
+        return re.search(r'Seq Scan on %s\b' % re.escape(table), plan) is not None
+    scan = re.compile(r'\bSCAN (TABLE )?%s\b' % re.escape(table))
+    for line in plan.splitlines():
+        # sqlite: "SCAN TABLE t" or "SCAN t", without "USING ... INDEX"
+        if scan.search(line) and 'INDEX' not in line:
+            return True
+    return False
+
+# Run against a database seeded with seed_inventory() so the planner sees
+# a realistic table size.
+# returns:
+# <List> of (lookup, problem, detail) for every selective lookup that
+# scans the whole vehicle table and every lookup taking more than one query
+def check_vehicle_query_plans():
+    table = Vehicle._meta.db_table
+    failures = []
+    for name, queryset, selective in vehicle_lookups():
+        plan = explain(queryset)
+        if selective and is_full_scan(plan, table):
+            failures.append((name, 'full scan', plan))
+        queries = count_queries(lambda: list(queryset.all()))
+        if queries != 1:
+            failures.append((name, 'queries', queries))
+    return failures
+
+# params:
+# 1. timings: sorted <List> of seconds
+# 2. pct: <Int> percentile wanted
+# returns:
+# <Float> nearest-rank percentile
+def percentile(timings, pct):
+    rank = max(int(round(pct / 100.0 * len(timings))) - 1, 0)
+    return timings[rank]
+
+# params:
+# 1. func: callable taking no arguments
+# 2. calls: <Int> timed calls after warmup
+# returns:
+# <Dict> latency percentiles in seconds and peak bytes allocated by one call
+def measure(func, calls=1000, warmup=50):
+    for i in range(warmup):
+        func()
+    timings = []
+    for i in range(calls):
+        started = perf_counter()
+        func()
+        timings.append(perf_counter() - started)
+    timings.sort()
+
+    tracemalloc.start()
+    func()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'p50': percentile(timings, 50),
+        'p90': percentile(timings, 90),
+        'p99': percentile(timings, 99),
+        'max': timings[-1],
+        'peak_bytes': peak,
+    }
+
+class SampleForm(object):
+    # stands in for a bound, valid form; adfxml only reads cleaned_data
+
+    def __init__(self, cleaned_data):
+        self.cleaned_data = cleaned_data
+
+def sample_cleaned_data():
+    return {
+        'stock_number': 'A00042',
+        'vin': '19UUA8F20GA000042',
+        'year_mfd': 2016,
+        'make': VehicleMake(name='Acura'),
+        'model': VehicleModel(name='TLX'),
+        'first_name': 'Jane',
+        'last_name': 'Doe',
+        'email': 'jane@example.com',
+        'address': '100 Bloomfield Avenue',
+        'city': 'Verona',
+        'state': 'NJ',
+        'zip_code': '07044',
+        'phone': '973-555-0100',
+        'message': 'Is this still available?',
+        'schedule_date': 'Monday Feb 01, 2016',
+        'scheduled_slot': '9 am - 11 am',
+    }
+
+LEAD_VIEWS = (
+    ContactFormView,
+    TestDriveFormView,
+    RequestQuoteFormView,
+    RequestInfoFormView,
+    ConfirmAvailabilityFormView,
+    VehicleFinanceFormView,
+    SendToMobileFormView,
+)
+
+# params:
+# 1. calls: <Int> timed calls per benchmark
+# returns:
+# <Dict> measure() results keyed by benchmark name
+def bench_lead_path(calls=1000):
+    form = SampleForm(sample_cleaned_data())
+    contact = dict((key, form.cleaned_data[key]) for key in (
+        'first_name', 'last_name', 'phone', 'email', 'address', 'city', 'state', 'zip_code'
+    ))
+    results = {
+        'get_contact_node': measure(lambda: get_contact_node(**contact), calls),
+        'get_vehicle_node': measure(lambda: get_vehicle_node(form, interest_type="buy"), calls),
+        'get_customer_node': measure(lambda: get_customer_node(form), calls),
+        'get_timeframe_node': measure(lambda: get_timeframe_node(
+            description="9 am - 11 am on Monday Feb 01, 2016",
+            earliestdate="2016-02-01T09:00:00",
+        ), calls),
+    }
+    with override_settings(DEBUG=False,
+            EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+        for view_class in LEAD_VIEWS:
+            view = view_class()
+            view.use_outbox = False
+            # the same sample lead is sent on every call
+            view.deduplicator = None
+            name = view_class.__name__
+            results[name + '.adfxml'] = measure(
+                lambda view=view: view.adfxml(form, etree.Element("prospect")), calls
+            )
+            results[name + '.build_adfxml'] = measure(
+                lambda view=view: view.build_adfxml(form), calls
+            )
+            # mail_adfxml records a Lead, which is rolled back afterwards
+            with transaction.atomic():
+                results[name + '.mail_adfxml'] = measure(
+                    lambda view=view: view.mail_adfxml(form), calls
+                )
+                transaction.set_rollback(True)
+            mail.outbox = []
+    return results
+
+# params:
+# 1. results: <Dict> as returned by bench_lead_path
+# 2. path: <String> file the baseline is written to
+def save_baseline(results, path):
+    with open(path, 'w') as baseline:
+        json.dump(results, baseline, indent=2, sort_keys=True)
+
+# params:
+# 1. results: <Dict> as returned by bench_lead_path
+# 2. path: <String> baseline written earlier by save_baseline
+# 3. tolerance: <Float> allowed slowdown of p50 and p90, 0.25 is 25%
+# returns:
+# <List> of (name, stat, baseline, current) for every regression
+def compare_to_baseline(results, path, tolerance=0.25):
+    with open(path) as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = []
+    for name, stats in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for stat in ('p50', 'p90'):
+            if stats[stat] > baseline[name][stat] * (1 + tolerance):
+                regressions.append((name, stat, baseline[name][stat], stats[stat]))
+    return regressions
+
+# params:
+# 1. baseline: <String> path of a saved baseline to compare against
+# 2. save: <Boolean> overwrite the baseline with this run
+# returns:
+# <List> of regressions, empty when there is no baseline
+def run(baseline=None, save=False):
+    for name, seconds in sorted(bench_row_coercion().items()):
+        print('%-24s %8.2f us/row' % (name, seconds * 1e6))
+
+    for name, seconds in sorted(bench_similar_vehicles().items()):
+        print('similar vehicles %-8s %10.2f us/lookup' % (name, seconds * 1e6))
+
+    for count, rates in sorted(bench_parallel_ingest().items(), key=lambda item: item[0] or 0):
+        print('workers %-4s coerce %9.0f rows/s  ingest %9.0f rows/s' % (
+            count or '-', rates['coerce'], rates['ingest'],
+        ))
+
+    results = bench_lead_path()
+    for name, stats in sorted(results.items()):
+        print('%-42s p50 %7.1f us  p90 %7.1f us  p99 %7.1f us  peak %6d B' % (
+            name, stats['p50'] * 1e6, stats['p90'] * 1e6, stats['p99'] * 1e6,
+            stats['peak_bytes'],
+        ))
+
+    regressions = []
+    if baseline and not save:
+        regressions = compare_to_baseline(results, baseline)
+        for name, stat, before, after in regressions:
+            print('REGRESSION %s %s %.1f us -> %.1f us' % (name, stat, before * 1e6, after * 1e6))
+    if baseline and save:
+        save_baseline(results, baseline)
+    return regressions
@@ -0,0 +1,240 @@
+"""
+Process-wide clients for the services the site calls out to: the url
+shortener and the SMS provider.
+
+Every upstream keeps one pooled client for the life of the process,
+applies connect/read timeouts to every call, records call latency and
+sits behind a circuit breaker, so a degraded service fails fast instead
+of holding web workers.
+
+Timeouts and breaker limits can be set per upstream in settings, e.g.
+
+    ADF_UPSTREAMS = {
+        'shortener': {'connect_timeout': 2, 'read_timeout': 3},
+        'sms': {'failure_threshold': 3, 'reset_timeout': 60},
+    }
+"""
+import threading
+from time import monotonic
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from twilio import TwilioRestException
+from twilio.rest import TwilioRestClient
+
+UPSTREAM_DEFAULTS = {
+    'connect_timeout': 3.05,
+    'read_timeout': 5,
+    'failure_threshold': 5, # consecutive failures before the circuit opens
+    'reset_timeout': 30, # seconds before an open circuit lets a call through
+    'pool_size': 10,
+}
+
+# upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class UpstreamUnavailable(Exception):
+    pass
+
+class CircuitBreaker(object):
+    """
+    Opens after failure_threshold consecutive failures. While open every
+    call is refused; after reset_timeout a single trial call is let
+    through, closing the circuit again if it succeeds.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = monotonic()
+
+class LatencyHistogram(object):
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.total = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                index = i
+                break
+        with self.lock:
+            self.counts[index] += 1
+            self.total += seconds
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'buckets': list(zip(self.buckets + ('+Inf',), self.counts)),
+                'sum': self.total,
+                'count': self.count,
+            }
+
+class Upstream(object):
+    """
+    Only errors that point at the service itself, such as timeouts,
+    refused connections and 5xx answers, count towards opening the
+    circuit. Errors caused by the request, like a 4xx for a bad phone
+    number, are raised without touching the breaker.
+    """
+
+    def __init__(self, name, connect_timeout, read_timeout, failure_threshold,
+            reset_timeout, pool_size):
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_size = pool_size
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.latency = LatencyHistogram()
+        self.errors = 0
+        self.client_errors = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def is_failure(self, error):
+        return True
+
+    def call(self, func, *args, **kwargs):
+        if not self.breaker.allow():
+            self.count('rejected')
+            raise UpstreamUnavailable(self.name + ' circuit is open')
+        started = monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if self.is_failure(e):
+                self.count('errors')
+                self.breaker.record_failure()
+            else:
+                self.count('client_errors')
+                # the service answered, so a half-open circuit can close
+                self.breaker.record_success()
+            raise
+        finally:
+            self.latency.observe(monotonic() - started)
+        self.breaker.record_success()
+        return result
+
+    def metrics(self):
+        metrics = self.latency.snapshot()
+        with self.lock:
+            metrics.update({
+                'errors': self.errors,
+                'client_errors': self.client_errors,
+                'rejected': self.rejected,
+            })
+        metrics['circuit'] = self.breaker.state
+        return metrics
+
+class HTTPUpstream(Upstream):
+    # one keep-alive session; error statuses count as failures
+
+    def __init__(self, name, **options):
+        super(HTTPUpstream, self).__init__(name, **options)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', (self.connect_timeout, self.read_timeout))
+        return self.call(self.checked_request, method, url, **kwargs)
+
+    def checked_request(self, method, url, **kwargs):
+        response = self.session.request(method, url, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def is_failure(self, error):
+        if isinstance(error, requests.HTTPError):
+            return error.response is None or error.response.status_code >= 500
+        return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+class SMSUpstream(Upstream):
+    # the Twilio client is built once and shared by every request
+
+    def __init__(self, name, **options):
+        super(SMSUpstream, self).__init__(name, **options)
+        self.client = TwilioRestClient(settings.TWILIO_ACCOUNT_SID,
+                settings.TWILIO_AUTH_TOKEN, timeout=self.read_timeout)
+
+    def is_failure(self, error):
+        if isinstance(error, TwilioRestException):
+            return error.status is None or error.status >= 500
+        # anything else never got an answer from Twilio
+        return True
+
+    def send(self, to, body, from_=None):
+        return self.call(self.client.messages.create,
+                to=to, from_=from_ or settings.TWILIO_NUMBER, body=body)
+
+upstreams = {}
+upstreams_lock = threading.Lock()
+
+def get_upstream(name, upstream_class):
+    try:
+        return upstreams[name]
+    except KeyError:
+        with upstreams_lock:
+            if name not in upstreams:
+                options = dict(UPSTREAM_DEFAULTS)
+                options.update(getattr(settings, 'ADF_UPSTREAMS', {}).get(name, {}))
+                upstreams[name] = upstream_class(name, **options)
+            return upstreams[name]
+
+def get_shortener():
+    return get_upstream('shortener', HTTPUpstream)
+
+def get_sms():
+    return get_upstream('sms', SMSUpstream)
+
+def upstream_metrics():
+    return dict((name, upstream.metrics()) for name, upstream in upstreams.items())
@@ -6,16 +6,55 @@ from localflavor.us import forms as us_forms
 from .models import *
 import ipdb
 
-class SendToMobileForm(forms.Form):
+class StockIndexedFormMixin(object):
+    """
+    Resolves the hidden make and model ids through the in-memory stock
+    index instead of querying VehicleMake and VehicleModel, and replaces
+    them with IndexedChoices carrying their names. Vehicles no longer in
+    stock fall back to the database, unless requires_stock is set. The
+    StockEntry found, or None, is kept in cleaned_data['stock_entry'].
+    """
+
+    requires_stock = False
+
+    def clean_vehicle(self, cleaned_data):
+        stock_number = cleaned_data.get('stock_number')
+        if stock_number is None:
+            return cleaned_data
+        entry = get_stock_index().lookup(stock_number)
+        cleaned_data['stock_entry'] = entry
+        if entry is None and self.requires_stock:
+            self.add_error('stock_number', "This vehicle is no longer in stock")
+            return cleaned_data
+        for field, model_class in (('make', VehicleMake), ('model', VehicleModel)):
+            pk = cleaned_data.get(field)
+            if pk is None:
+                continue
+            if entry is not None and getattr(entry, field).id == pk:
+                cleaned_data[field] = getattr(entry, field)
+                continue
+            name = model_class.objects.filter(pk=pk).values_list('name', flat=True).first()
+            if name is None:
+                self.add_error(field, "Select a valid choice.")
+            else:
+                cleaned_data[field] = IndexedChoice(pk, name)
+        return cleaned_data
+
+class SendToMobileForm(StockIndexedFormMixin, forms.Form):
+    requires_stock = True
     stock_number = forms.CharField(max_length=20,widget=forms.HiddenInput())
     vin = forms.CharField(max_length=20,widget=forms.HiddenInput())
     year_mfd = forms.IntegerField(widget=forms.HiddenInput())
-    make = forms.ModelChoiceField(queryset=VehicleMake.objects.all(),widget=forms.HiddenInput())
-    model = forms.ModelChoiceField(queryset=VehicleModel.objects.all(),widget=forms.HiddenInput())
+    make = forms.IntegerField(widget=forms.HiddenInput())
+    model = forms.IntegerField(widget=forms.HiddenInput())
     first_name = forms.CharField(max_length=100)
     last_name = forms.CharField(max_length=100)
     phone = us_forms.USPhoneNumberField(required=True)
 
+    def clean(self):
+        cleaned_data = super(SendToMobileForm, self).clean()
+        return self.clean_vehicle(cleaned_data)
+
 class ContactForm(forms.Form):
     first_name = forms.CharField(max_length=100)
     last_name = forms.CharField(max_length=100)
@@ -37,14 +76,14 @@ class ContactForm(forms.Form):
             self.add_error('email', msg)
             self.add_error('phone', msg)
 
-class VehicleEnquiryForm(forms.Form):
+class VehicleEnquiryForm(StockIndexedFormMixin, forms.Form):
     # always have the same field names stock_number, vin, year_mfd, make, model
     # look at inventory.models.Vehicle.handlebars_context for explanation
     stock_number = forms.CharField(max_length=20,widget=forms.HiddenInput())
     vin = forms.CharField(max_length=20,widget=forms.HiddenInput())
     year_mfd = forms.IntegerField(widget=forms.HiddenInput())
-    make = forms.ModelChoiceField(queryset=VehicleMake.objects.all(),widget=forms.HiddenInput())
-    model = forms.ModelChoiceField(queryset=VehicleModel.objects.all(),widget=forms.HiddenInput())
+    make = forms.IntegerField(widget=forms.HiddenInput())
+    model = forms.IntegerField(widget=forms.HiddenInput())
     first_name = forms.CharField(max_length=100)
     last_name = forms.CharField(max_length=100)
     email = forms.EmailField(required=False)
@@ -56,7 +95,7 @@ class VehicleEnquiryForm(forms.Form):
     message = forms.CharField(widget=forms.TextInput())
 
     def clean(self):
-        cleaned_data = super(VehicleEnquiryForm, self).clean()
+        cleaned_data = self.clean_vehicle(super(VehicleEnquiryForm, self).clean())
         email = cleaned_data.get('email')
         phone = cleaned_data.get('phone')
         if len(email)==0 and len(phone)==0:
@@ -0,0 +1,278 @@
+"""
+Timers and counters for the lead submission and inventory import hot paths.
+
+Instrumentation is off unless enabled in settings. While it is off
+`timer()` hands back one shared no-op context manager, `incr()` returns
+straight away and `timed()` gives back the iterable it was passed, so
+the instrumented code costs one attribute check per call.
+
+While it is on, timings go into latency histograms and counters that
+are handed to a sink every flush_interval seconds, or when `flush()` is
+called:
+
+    ADF_INSTRUMENTATION = {
+        'enabled': True,
+        'sink': 'prometheus', # 'log', 'memory' or 'prometheus'
+        'path': '/var/lib/node_exporter/adf.prom', # prometheus only
+        'flush_interval': 60,
+    }
+
+Tests and benchmarks can swap the configuration with `configure()`:
+
+    sink = configure(enabled=True, sink=MemorySink())
+    ...
+    flush()
+    sink.histogram('lead_adfxml_build_seconds')['count']
+"""
+import logging
+import os
+import threading
+from time import monotonic
+
+from django.conf import settings
+
+from .clients import LatencyHistogram
+
+INSTRUMENTATION_DEFAULTS = {
+    'enabled': False,
+    'sink': 'log',
+    'path': None,
+    'flush_interval': 60, # seconds between exports, None to only flush on demand
+}
+
+logger = logging.getLogger('adf.instrumentation')
+
+# upper bounds, in seconds, of the stage histogram buckets; finer than
+# the upstream ones since single import rows take microseconds
+STAGE_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1,
+        0.25, 0.5, 1, 2.5, 5, 10)
+
+class NullTimer(object):
+    # what timer() returns while instrumentation is off
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_TIMER = NullTimer()
+
+class Timer(object):
+    __slots__ = ('instruments', 'name', 'started')
+
+    def __init__(self, instruments, name):
+        self.instruments = instruments
+        self.name = name
+
+    def __enter__(self):
+        self.started = monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instruments.observe(self.name, monotonic() - self.started)
+        return False
+
+class LogSink(object):
+    # one line per metric on the adf.instrumentation logger
+
+    def __init__(self, logger_name='adf.instrumentation'):
+        self.logger = logging.getLogger(logger_name)
+
+    def emit(self, snapshot):
+        for name, histogram in sorted(snapshot['histograms'].items()):
+            mean = histogram['sum'] / histogram['count'] if histogram['count'] else 0
+            self.logger.info('%s count=%d sum=%.6f mean=%.6f', name,
+                    histogram['count'], histogram['sum'], mean)
+        for name, value in sorted(snapshot['counters'].items()):
+            self.logger.info('%s value=%d', name, value)
+
+class MemorySink(object):
+    # keeps every snapshot it is given, for tests and benchmarks
+
+    def __init__(self):
+        self.snapshots = []
+
+    def emit(self, snapshot):
+        self.snapshots.append(snapshot)
+
+    def histogram(self, name):
+        for snapshot in reversed(self.snapshots):
+            if name in snapshot['histograms']:
+                return snapshot['histograms'][name]
+        return None
+
+    def counter(self, name):
+        for snapshot in reversed(self.snapshots):
+            if name in snapshot['counters']:
+                return snapshot['counters'][name]
+        return 0
+
+    def clear(self):
+        self.snapshots = []
+
+# params:
+# 1. snapshot: <Dict> as built by Instruments.snapshot
+# returns:
+# <String> the metrics in the Prometheus text exposition format
+def prometheus_text(snapshot):
+    lines = []
+    for name, histogram in sorted(snapshot['histograms'].items()):
+        lines.append('# TYPE %s histogram' % name)
+        cumulative = 0
+        for bound, count in histogram['buckets']:
+            cumulative += count
+            lines.append('%s_bucket{le="%s"} %d' % (name, bound, cumulative))
+        lines.append('%s_sum %.6f' % (name, histogram['sum']))
+        lines.append('%s_count %d' % (name, histogram['count']))
+    for name, value in sorted(snapshot['counters'].items()):
+        lines.append('# TYPE %s counter' % name)
+        lines.append('%s %d' % (name, value))
+    return '\n'.join(lines) + '\n'
+
+class PrometheusTextSink(object):
+    """
+    Renders the metrics in the Prometheus text format. With a path the
+    text replaces that file atomically, e.g. for node_exporter's textfile
+    collector; `text` always holds the latest dump.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.text = ''
+
+    def emit(self, snapshot):
+        self.text = prometheus_text(snapshot)
+        if self.path:
+            # unique per writer, so concurrent dumps never share a temp file
+            partial_path = '%s.%d.%d' % (self.path, os.getpid(), threading.get_ident())
+            with open(partial_path, 'w') as out:
+                out.write(self.text)
+            os.replace(partial_path, self.path)
+
+SINKS = {
+    'log': LogSink,
+    'memory': MemorySink,
+    'prometheus': PrometheusTextSink,
+}
+
+class Instruments(object):
+    # histograms and counters accumulate for the life of the process
+
+    def __init__(self, enabled=False, sink=None, flush_interval=None):
+        self.enabled = enabled
+        self.sink = sink
+        self.flush_interval = flush_interval
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.flushed_at = monotonic()
+
+    def observe(self, name, seconds):
+        try:
+            histogram = self.histograms[name]
+        except KeyError:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, LatencyHistogram(STAGE_BUCKETS))
+        histogram.observe(seconds)
+        self.maybe_flush()
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if self.flush_interval is None or monotonic() - self.flushed_at < self.flush_interval:
+            return
+        # one thread exports, the others carry on without waiting for it
+        if not self.flush_lock.acquire(False):
+            return
+        try:
+            if monotonic() - self.flushed_at >= self.flush_interval:
+                self.export()
+        finally:
+            self.flush_lock.release()
+
+    def snapshot(self):
+        with self.lock:
+            histograms = list(self.histograms.items())
+            counters = dict(self.counters)
+        return {
+            'histograms': dict((name, histogram.snapshot()) for name, histogram in histograms),
+            'counters': counters,
+        }
+
+    def flush(self):
+        with self.flush_lock:
+            self.export()
+
+    def export(self):
+        # the caller holds flush_lock; a failing sink must never reach the
+        # code being timed
+        self.flushed_at = monotonic()
+        if self.sink is None:
+            return
+        try:
+            self.sink.emit(self.snapshot())
+        except Exception:
+            logger.exception('Instrumentation sink %r failed', self.sink)
+
+# params:
+# 1. options: <Dict> ADF_INSTRUMENTATION style settings
+# returns:
+# <Instruments> with the sink the options name
+def instruments_from_options(options):
+    config = dict(INSTRUMENTATION_DEFAULTS)
+    config.update(options)
+    sink = config['sink']
+    if isinstance(sink, str):
+        sink = PrometheusTextSink(config['path']) if sink == 'prometheus' else SINKS[sink]()
+    return Instruments(config['enabled'], sink, config['flush_interval'])
+
+instruments = instruments_from_options(getattr(settings, 'ADF_INSTRUMENTATION', {}))
+
+# params:
+# same keys as ADF_INSTRUMENTATION, a sink may also be a sink instance
+# returns:
+# the sink now in use
+def configure(**options):
+    global instruments
+    if instruments.enabled:
+        instruments.flush()
+    instruments = instruments_from_options(options)
+    return instruments.sink
+
+def timer(name):
+    if not instruments.enabled:
+        return NULL_TIMER
+    return Timer(instruments, name)
+
+def incr(name, value=1):
+    if instruments.enabled:
+        instruments.incr(name, value)
+
+# params:
+# 1. name: <String> histogram the time spent producing each item goes to
+# 2. iterable: <Iterable>
+# returns:
+# <Iterable> yielding the same items
+def timed(name, iterable):
+    if not instruments.enabled:
+        return iterable
+    return timed_items(instruments, name, iterable)
+
+def timed_items(instruments, name, iterable):
+    iterator = iter(iterable)
+    while True:
+        started = monotonic()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        instruments.observe(name, monotonic() - started)
+        yield item
+
+def flush():
+    instruments.flush()
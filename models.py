@@ -1,16 +1,31 @@
+import csv
+import hashlib
+import heapq
 import json
+import multiprocessing
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial, lru_cache
+from itertools import islice
 from operator import itemgetter, contains
-from django.utils.timezone import datetime, timedelta
-import requests
+from django.utils.timezone import datetime, timedelta, now
 
 import ipdb
 
 from django.utils.text import slugify
-from django.db import models
+from django.db import connection, models, transaction
 from django.forms import widgets
 from django.core.urlresolvers import reverse
 from django.conf import settings
+from django.core.cache import caches
+from django.core.mail import EmailMessage, get_connection
+
+from .clients import UpstreamUnavailable, get_shortener
+from .instrumentation import incr, timed, timer
 
 CSV_TO_MODEL_FIELD_MAP = {
     'Stock': 'stock_number',
@@ -60,31 +75,62 @@ CSV_TO_MODEL_FIELD_MAP = {
     'EngineDisplacementCubicInches': 'disp_cub_inches',
 }
 
+class InvalidFeedValue(ValueError):
+    # a feed cell that can't be converted to its Vehicle field
+    pass
+
 # params: 1. <String> new_or_used_str which has values of 'New' or 'Used'
 # returns: 2. <Boolean> True for 'New' and False for 'Used'
-# raises Unknown classification error
+# raises InvalidFeedValue for anything else
 def vehicle_type_to_boolean(new_or_used_str):
     if new_or_used_str == 'New':
         return True
     elif new_or_used_str == 'Used':
         return False
     else:
-        raise Exception("Unknown Vehicle Type Passed")
+        raise InvalidFeedValue("Unknown Vehicle Type Passed: %r" % new_or_used_str)
 
 # params: 1. <String> cert_str which has values of 'True' or 'False'
 # returns: 2. <Boolean> True for 'True' and False for 'False'
-# raises Unknown classification error
+# raises InvalidFeedValue for anything else
 def cert_to_boolean(cert_str):
     if cert_str == 'True':
         return True
     elif cert_str == 'False':
         return False
     else:
-        raise Exception("Unknown Certification Status Passed")
+        raise InvalidFeedValue("Unknown Certification Status Passed: %r" % cert_str)
 
+# params:
+# 1. cat_options: <String> "category@option~category@option..."
+# returns:
+# <Dict> category -> <List> of options, in feed order
+def parse_categorized_options(cat_options):
+    cats = {}
+    for cat_opt in cat_options.split('~'):
+        cat, sep, opt = cat_opt.partition('@')
+        if not sep:
+            continue
+        try:
+            cats[cat].append(opt)
+        except KeyError as e:
+            cats[cat] = [opt]
+    return cats
+
+def categorized_options_json(cat_options):
+    return json.dumps(parse_categorized_options(cat_options))
+
+# params: 1. <String> str_val displacement in litres, e.g. '2.4L'
+# returns: <Float> 2.4
+# raises InvalidFeedValue when there is no litre value
 def number_displacement(str_val):
     l_indx = str_val.find('L')
-    return float(str_val[:l_indx])
+    if l_indx == -1:
+        raise InvalidFeedValue("Displacement without L: %r" % str_val)
+    try:
+        return float(str_val[:l_indx])
+    except ValueError:
+        raise InvalidFeedValue("Unknown Displacement Passed: %r" % str_val)
 
 # params:
 # 1. vehicle_obj: <Vehicle>
@@ -147,13 +193,14 @@ def handle_direct_field(vehicle, mapped_field_name, val):
 # params:
 # 1. key_map: <Dict>
 # 2. row: a row of <csv.DictReader>
-# returns: <Vehicle>
-def parse_csv_row(key_map, row):
+# returns: <Vehicle> unsaved, with every column populated except
+# the make, body and model relations
+def vehicle_from_csv_row(key_map, row):
     vehicle = Vehicle()
     for key, val in row.items():
         mapped_field_name = key_map.get(key,None)
 
-        if is_ignored_col(key):
+        if is_ignored_col(key) or key == 'Make':
             continue
         elif not mapped_field_name is None:
             vehicle = handle_direct_field(vehicle, mapped_field_name, val)
@@ -163,37 +210,840 @@ def parse_csv_row(key_map, row):
                 vehicle.is_new = vehicle_type_to_boolean(val)
             elif key == 'Certified':
                 vehicle.certified = cert_to_boolean(val)
-            elif key == 'Make':
-                vehicle.make, is_new_make = VehicleMake.objects.get_or_create(name=val)
             elif key == 'EngineDisplacement':
                 vehicle.displacement = number_displacement(val)
             elif key == 'DateInStock':
-                vehicle.date_in_stock = datetime.strptime(val, '%m/%d/%Y')
+                vehicle.date_in_stock = date_in_stock_from_str(val)
             else:
                 print('Unknown column in csv field '+ key)
+    return vehicle
 
-    # body style
-    vehicle.body, is_new_body = BodyStyle.objects.get_or_create(
-        name=row['Body']
-    )
+def int_or_zero(val):
+    try:
+        return int(val)
+    except ValueError as e:
+        return 0
 
-    # vehicle model
-    vehicle.model, is_new_model = VehicleModel.objects.get_or_create(
-        make=vehicle.make,
-        number=row['ModelNumber'],
-        name=row['Model'],
-        doors=int(row['Doors']),
-    )
-    vehicle.save()
+def float_or_zero(val):
+    try:
+        return float(val)
+    except ValueError as e:
+        return 0.0
+
+def date_in_stock_from_str(val):
+    try:
+        return datetime.strptime(val, '%m/%d/%Y')
+    except ValueError:
+        raise InvalidFeedValue("Unknown DateInStock Passed: %r" % val)
+
+# csv columns handled by name rather than through the key map,
+# with the Vehicle field and converter each one feeds
+SPECIAL_COLUMN_CONVERTERS = {
+    'Type': ('is_new', vehicle_type_to_boolean),
+    'Certified': ('certified', cert_to_boolean),
+    'EngineDisplacement': ('displacement', number_displacement),
+    'DateInStock': ('date_in_stock', date_in_stock_from_str),
+}
+# Make is resolved to a VehicleMake with the other relations
+SPECIAL_COLUMNS = tuple(SPECIAL_COLUMN_CONVERTERS) + ('Make',)
+
+class ColumnPlan(object):
+    """
+    A csv header compiled once into the work each row needs: the columns
+    copied as they are and the (column, field, converter) triples for the
+    rest. Calling the plan with a row returns the Vehicle field values,
+    with the same results as vehicle_from_csv_row but none of its
+    per-cell classification.
+    """
+
+    def __init__(self, key_map, header):
+        self.header = tuple(header)
+        self.copied = []
+        self.converted = []
+        for key in self.header:
+            mapped_field_name = key_map.get(key, None)
+            if is_ignored_col(key) or key == 'Make':
+                continue
+            elif not mapped_field_name is None:
+                if is_int_field(mapped_field_name):
+                    self.converted.append((key, mapped_field_name, int_or_zero))
+                elif is_float_field(mapped_field_name):
+                    self.converted.append((key, mapped_field_name, float_or_zero))
+                else:
+                    self.copied.append((key, mapped_field_name))
+            elif key in SPECIAL_COLUMN_CONVERTERS:
+                field_name, converter = SPECIAL_COLUMN_CONVERTERS[key]
+                self.converted.append((key, field_name, converter))
+            else:
+                print('Unknown column in csv field '+ key)
+
+    def field_names(self):
+        field_names = [field_name for key, field_name in self.copied] + [
+            field_name for key, field_name, converter in self.converted
+        ]
+        if 'cat_options' in field_names:
+            field_names.append('categorized_options')
+        return field_names
+
+    def __call__(self, row):
+        fields = dict((field_name, row[key]) for key, field_name in self.copied)
+        for key, field_name, converter in self.converted:
+            fields[field_name] = converter(row[key])
+        if 'cat_options' in fields:
+            fields['categorized_options'] = categorized_options_json(fields['cat_options'])
+        return fields
+
+# params:
+# 1. key_map: <Dict>
+# 2. header: <Iterable> of csv column names
+# returns:
+# <ColumnPlan>, shared by every feed with the same header
+@lru_cache(maxsize=32)
+def compile_csv_header(key_map_items, header):
+    return ColumnPlan(dict(key_map_items), header)
+
+# params:
+# 1. key_map: <Dict>
+# 2. header: <Iterable> of csv column names
+# returns:
+# <ColumnPlan>
+def column_plan(key_map, header):
+    return compile_csv_header(tuple(sorted(key_map.items())), tuple(header))
+
+# params:
+# 1. key_map: <Dict>
+# 2. row: a row of <csv.DictReader>
+# returns: <Vehicle>
+def parse_csv_row(key_map, row):
+    incr('import_rows_total')
+    with timer('import_coerce_seconds'):
+        vehicle = vehicle_from_csv_row(key_map, row)
+
+    with timer('import_get_or_create_seconds'):
+        vehicle.make, is_new_make = VehicleMake.objects.get_or_create(name=row['Make'])
+
+        # body style
+        vehicle.body, is_new_body = BodyStyle.objects.get_or_create(
+            name=row['Body']
+        )
+
+        # vehicle model
+        vehicle.model, is_new_model = VehicleModel.objects.get_or_create(
+            make=vehicle.make,
+            number=row['ModelNumber'],
+            name=row['Model'],
+            doors=int(row['Doors']),
+        )
+    with timer('import_save_seconds'):
+        # the same slug assign_vehicle_slugs gives, with the dealer's location
+        slug = vehicle_slug(
+            row['Make'], row['Model'], vehicle.year_mfd, vehicle.stock_number,
+            dealer_location(row.get('DealerName')),
+        )
+        vehicle.slug = SlugAllocator.for_slug(slug).allocate(slug)
+        vehicle.save()
     vehicle_image_for_vehicle = partial(vehicle_image_obj_mkr, vehicle)
     bulk_list = map(vehicle_image_for_vehicle, row['ImageList'].split(','))
-    VehicleImage.objects.bulk_create(bulk_list)
+    with timer('import_image_bulk_create_seconds'):
+        VehicleImage.objects.bulk_create(bulk_list)
     return vehicle
 
 cust_parse_csv_row = partial(parse_csv_row, CSV_TO_MODEL_FIELD_MAP)
 
+# rows written per transaction by the bulk importer
+IMPORT_CHUNK_SIZE = 500
+
+# params:
+# 1. iterable: <Iterable>
+# 2. size: <Int>
+# returns:
+# generator of <List>s holding at most size items each
+def iter_chunks(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+# location used in slugs when a dealer has none configured
+DEFAULT_DEALER_LOCATION = "Verona NJ"
+
+# params:
+# 1. dealer_name: <String> the DealerName column of a feed row
+# returns:
+# <String> location for the dealer's vehicle slugs, from
+# settings.DEALER_LOCATIONS, then settings.DEALER_LOCATION
+def dealer_location(dealer_name=None):
+    locations = getattr(settings, 'DEALER_LOCATIONS', {})
+    if dealer_name in locations:
+        return locations[dealer_name]
+    return getattr(settings, 'DEALER_LOCATION', DEFAULT_DEALER_LOCATION)
+
+# params:
+# 1. make_name, model_name: <String>
+# 2. year_mfd: <Int>
+# 3. stock_number: <String>
+# 4. location: <String> defaults to dealer_location()
+# returns:
+# <String> the slug Vehicle.save would give this vehicle
+def vehicle_slug(make_name, model_name, year_mfd, stock_number, location=None):
+    if location is None:
+        location = dealer_location()
+    slug_input = "vehicle " + make_name + " " + model_name
+    slug_input += " " + str(year_mfd)
+    slug_input += " " + location + " "
+    slug_input += stock_number
+    return slugify(slug_input)[:200] # truncate to field size
+
+class SlugAllocator(object):
+    """
+    Hands out unique vehicle slugs against the set of slugs already taken,
+    so a batch can be given all its slugs up front and written with
+    bulk_create instead of failing on the unique constraint halfway. A
+    taken slug gets the first free "-2", "-3", ... suffix.
+    """
+
+    MAX_LENGTH = 200
+
+    def __init__(self, taken=None):
+        if taken is None:
+            taken = Vehicle.objects.values_list('slug', flat=True).iterator()
+        self.taken = set(taken)
+
+    @classmethod
+    def for_slug(cls, slug):
+        # only loads the slugs that could collide with this one
+        return cls(Vehicle.objects.filter(
+            slug__startswith=slug[:cls.MAX_LENGTH - 10]
+        ).values_list('slug', flat=True))
+
+    def allocate(self, slug):
+        candidate = slug
+        suffix = 1
+        while candidate in self.taken:
+            suffix += 1
+            tail = '-' + str(suffix)
+            candidate = slug[:self.MAX_LENGTH - len(tail)] + tail
+        self.taken.add(candidate)
+        return candidate
+
+# params:
+# 1. pairs: <List> of (<csv.DictReader> row, unsaved <Vehicle>) tuples
+# 2. allocator: <SlugAllocator>
+# returns:
+# <List> of the slugs given to the vehicles, in order
+def assign_vehicle_slugs(pairs, allocator):
+    slugs = []
+    for row, vehicle in pairs:
+        vehicle.slug = allocator.allocate(vehicle_slug(
+            row['Make'], row['Model'], vehicle.year_mfd, vehicle.stock_number,
+            dealer_location(row.get('DealerName')),
+        ))
+        slugs.append(vehicle.slug)
+    return slugs
+
+class VehicleLookupCache(object):
+    """
+    In-memory maps of the make, body style and model rows a feed refers
+    to, so the bulk importer doesn't pay a get_or_create per row.
+    Missing entries are created once per chunk with bulk_create. Also
+    carries the SlugAllocator for the vehicles the import creates.
+    """
+
+    def __init__(self):
+        self.slugs = SlugAllocator()
+        self.makes = dict(VehicleMake.objects.values_list('name', 'id'))
+        self.bodies = dict(BodyStyle.objects.values_list('name', 'id'))
+        self.models = {}
+        for pk, make_id, number, name, doors in VehicleModel.objects.values_list(
+                'id', 'make_id', 'number', 'name', 'doors'):
+            self.models[(make_id, number, name, doors)] = pk
+
+    def model_key(self, row):
+        return (
+            self.makes[row['Make']],
+            row['ModelNumber'],
+            row['Model'],
+            int(row['Doors']),
+        )
+
+    def add_missing(self, rows):
+        new_makes = set(row['Make'] for row in rows) - set(self.makes)
+        if new_makes:
+            VehicleMake.objects.bulk_create([VehicleMake(name=name) for name in new_makes])
+            self.makes.update(
+                VehicleMake.objects.filter(name__in=new_makes).values_list('name', 'id')
+            )
+
+        new_bodies = set(row['Body'] for row in rows) - set(self.bodies)
+        if new_bodies:
+            BodyStyle.objects.bulk_create([BodyStyle(name=name) for name in new_bodies])
+            self.bodies.update(
+                BodyStyle.objects.filter(name__in=new_bodies).values_list('name', 'id')
+            )
+
+        new_models = set(self.model_key(row) for row in rows) - set(self.models)
+        if new_models:
+            VehicleModel.objects.bulk_create([
+                VehicleModel(make_id=make_id, number=number, name=name, doors=doors)
+                for make_id, number, name, doors in new_models
+            ])
+            make_ids = set(key[0] for key in new_models)
+            for pk, make_id, number, name, doors in VehicleModel.objects.filter(
+                    make_id__in=make_ids).values_list(
+                    'id', 'make_id', 'number', 'name', 'doors'):
+                self.models[(make_id, number, name, doors)] = pk
+
+# params:
+# 1. pairs: <List> of (<csv.DictReader> row, <Vehicle>) tuples
+# 2. lookups: <VehicleLookupCache>
+# returns:
+# <List> of the <Vehicle>s with make, body and model ids set
+def resolve_vehicle_relations(pairs, lookups):
+    lookups.add_missing([row for row, vehicle in pairs])
+    vehicles = []
+    for row, vehicle in pairs:
+        vehicle.make_id = lookups.makes[row['Make']]
+        vehicle.body_id = lookups.bodies[row['Body']]
+        vehicle.model_id = lookups.models[lookups.model_key(row)]
+        vehicles.append(vehicle)
+    return vehicles
+
+# params:
+# 1. pairs: <List> of (<csv.DictReader> row, unsaved <Vehicle>) tuples
+# 2. lookups: <VehicleLookupCache>
+# returns:
+# <List> of the saved <Vehicle>s
+def write_vehicle_chunk(pairs, lookups):
+    rows = [row for row, vehicle in pairs]
+    vehicles = resolve_vehicle_relations(pairs, lookups)
+    assign_vehicle_slugs(pairs, lookups.slugs)
+    Vehicle.objects.bulk_create(vehicles)
+
+    # bulk_create doesn't hand back primary keys on every backend
+    ids = dict(Vehicle.objects.filter(
+        slug__in=[vehicle.slug for vehicle in vehicles]
+    ).values_list('slug', 'id'))
+    images = []
+    for vehicle, row in zip(vehicles, rows):
+        vehicle.pk = ids[vehicle.slug]
+        vehicle_image_for_vehicle = partial(vehicle_image_obj_mkr, vehicle)
+        images.extend(map(vehicle_image_for_vehicle, image_urls_from_row(row)))
+    VehicleImage.objects.bulk_create(images, batch_size=image_batch_size(images))
+    index_vehicle_options(vehicles)
+    return vehicles
+
+# images inserted per statement, where the backend allows that many
+IMAGE_BATCH_SIZE = 5000
+
+# params:
+# 1. images: <List> of unsaved <VehicleImage>s
+# 2. batch_size: <Int> wanted rows per INSERT
+# returns:
+# <Int> batch_size capped at what the backend takes in one statement; an
+# explicit batch_size otherwise overrides e.g. SQLite's 999 variable limit
+def image_batch_size(images, batch_size=IMAGE_BATCH_SIZE):
+    fields = VehicleImage._meta.concrete_fields
+    return min(batch_size, connection.ops.bulk_batch_size(fields, images))
+
+# params:
+# 1. row: a row of <csv.DictReader>
+# returns:
+# <List> of the image urls in ImageList, in feed order, blanks dropped
+def image_urls_from_row(row):
+    return [url.strip() for url in row['ImageList'].split(',') if url.strip()]
+
+# params:
+# 1. vehicle_urls: <List> of (vehicle id, <List> of image urls) tuples
+# 2. batch_size: <Int>
+# returns:
+# <Tuple> number of images inserted and deleted
+#
+# Brings the stored images of a whole batch of vehicles in line with the
+# feed with one select, bulk deletes and bulk inserts. Images that are
+# still listed keep their rows, and with them their ids and order, as
+# long as they keep their place in the list; so thumbnail only changes
+# when the feed's first image does.
+def sync_vehicle_images(vehicle_urls, batch_size=IMAGE_BATCH_SIZE):
+    stored = {}
+    ids = [vehicle_id for vehicle_id, urls in vehicle_urls]
+    for chunk in iter_chunks(ids, IMPORT_CHUNK_SIZE):
+        for image_id, vehicle_id, url in VehicleImage.objects.filter(
+                vehicle_id__in=chunk).order_by('id').values_list('id', 'vehicle_id', 'url'):
+            stored.setdefault(vehicle_id, []).append((image_id, url))
+
+    deletes = []
+    inserts = []
+    for vehicle_id, urls in vehicle_urls:
+        listed = set(urls)
+        kept = []
+        for image_id, url in stored.get(vehicle_id, []):
+            if url in listed:
+                kept.append((image_id, url))
+            else:
+                deletes.append(image_id)
+        # everything after the first out of place image is rewritten
+        same = 0
+        while same < len(kept) and same < len(urls) and kept[same][1] == urls[same]:
+            same += 1
+        deletes.extend(image_id for image_id, url in kept[same:])
+        inserts.extend(VehicleImage(vehicle_id=vehicle_id, url=url) for url in urls[same:])
+
+    # id lists stay within what every backend accepts in one IN clause
+    for chunk in iter_chunks(deletes, IMPORT_CHUNK_SIZE):
+        VehicleImage.objects.filter(id__in=chunk).delete()
+    VehicleImage.objects.bulk_create(inserts, batch_size=image_batch_size(inserts, batch_size))
+    return len(inserts), len(deletes)
+
+class FeedPipeline(object):
+    """
+    Streams a feed through read -> map -> coerce -> batch -> write.
+
+    Every stage is a generator pulling from the one before it, so a slow
+    writer stalls the reader instead of letting rows pile up: at most
+    chunk_size rows are alive at any time, whatever the size of the file.
+    `counts` holds the number of rows each stage has handed on and
+    `backlog()` the rows queued between neighbouring stages.
+    """
+
+    STAGES = ('read', 'map', 'coerce', 'batch', 'write')
+
+    def __init__(self, key_map=CSV_TO_MODEL_FIELD_MAP, chunk_size=IMPORT_CHUNK_SIZE):
+        self.key_map = key_map
+        self.chunk_size = chunk_size
+        self.counts = dict((stage, 0) for stage in self.STAGES)
+        self.plan = None
+
+    def counted(self, stage, items, weight=None):
+        # counts are in rows, so batches are weighed by their length
+        for item in items:
+            self.counts[stage] += 1 if weight is None else weight(item)
+            yield item
+
+    def backlog(self):
+        # rows a stage has produced that the next one hasn't taken yet
+        return dict(
+            (stage, self.counts[stage] - self.counts[following])
+            for stage, following in zip(FeedPipeline.STAGES, FeedPipeline.STAGES[1:])
+        )
+
+    def read(self, feed_file, encoding='utf-8'):
+        if isinstance(feed_file, str):
+            with open(feed_file, newline='', encoding=encoding) as feed:
+                for row in timed('import_csv_read_seconds', csv.DictReader(feed)):
+                    yield row
+        else:
+            for row in timed('import_csv_read_seconds', csv.DictReader(feed_file)):
+                yield row
+
+    def map_headers(self, rows):
+        for row in rows:
+            if self.plan is None:
+                # the header is compiled once instead of classifying every cell
+                self.plan = column_plan(self.key_map, row)
+            yield row
+
+    def coerce(self, rows):
+        for row in rows:
+            yield row, Vehicle(**self.plan(row))
+
+    def batch(self, items):
+        return iter_chunks(items, self.chunk_size)
+
+    def write(self, batches):
+        lookups = VehicleLookupCache()
+        for batch in batches:
+            with transaction.atomic():
+                write_vehicle_chunk(batch, lookups)
+            yield len(batch)
+
+    def run_rows(self, rows):
+        started = time.time()
+        stages = self.counted('read', rows)
+        stages = self.counted('map', self.map_headers(stages))
+        stages = self.counted('coerce', self.coerce(stages))
+        stages = self.counted('batch', self.batch(stages), weight=len)
+        written = sum(self.counted('write', self.write(stages), weight=int))
+        bump_inventory_version()
+        return import_stats(written, time.time() - started)
+
+    def run(self, feed_file):
+        return self.run_rows(self.read(feed_file))
+
+# params:
+# 1. key_map_items: <Tuple> sorted items of the key map
+# 2. header: <Tuple> csv column names
+# 3. rows: <List> of row value <Tuple>s in header order
+# returns:
+# <List> of value <Tuple>s in plan.field_names() order, one per row, in
+# the same order; tuples keep the keys out of the pickles both ways
+def coerce_feed_rows(key_map_items, header, rows):
+    plan = compile_csv_header(key_map_items, header)
+    names = plan.field_names()
+    coerced = []
+    for values in rows:
+        fields = plan(dict(zip(header, values)))
+        coerced.append(tuple(fields[name] for name in names))
+    return coerced
+
+class ProcessFeedPipeline(FeedPipeline):
+    """
+    FeedPipeline with the coerce stage spread over a process pool.
+
+    Workers turn chunks of row value tuples into field value tuples, so
+    no column names are pickled either way, while this process keeps the
+    rows and lookups and does every database write; the pool scales
+    coercion without competing for the database. Chunks come back in
+    submission order, which keeps the import deterministic, and no more
+    than two chunks per worker are in flight, which keeps memory bounded.
+    This process still builds every Vehicle, which caps the speedup;
+    benchmarks.bench_parallel_ingest measures it against the single
+    process pipeline. Workers are always forked, whatever the platform's
+    default start method, so the Django setup of the parent carries over.
+    """
+
+    def __init__(self, key_map=CSV_TO_MODEL_FIELD_MAP, chunk_size=IMPORT_CHUNK_SIZE,
+            workers=None):
+        super(ProcessFeedPipeline, self).__init__(key_map, chunk_size)
+        self.workers = workers or os.cpu_count()
+
+    def coerce(self, rows):
+        key_map_items = tuple(sorted(self.key_map.items()))
+        header = self.plan.header
+        row_values = itemgetter(*header)
+        self.field_names = self.plan.field_names()
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=self.workers,
+                mp_context=multiprocessing.get_context('fork')) as pool:
+            for chunk in iter_chunks(rows, self.chunk_size):
+                # the rows stay here for the write stage; workers get values only
+                pending.append((chunk, pool.submit(
+                    coerce_feed_rows, key_map_items, header,
+                    [row_values(row) for row in chunk]
+                )))
+                if len(pending) >= self.workers * 2:
+                    for pair in self.collect(pending.popleft()):
+                        yield pair
+            while pending:
+                for pair in self.collect(pending.popleft()):
+                    yield pair
+
+    def collect(self, submitted):
+        chunk, future = submitted
+        names = self.field_names
+        for row, values in zip(chunk, future.result()):
+            yield row, Vehicle(**dict(zip(names, values)))
+
+class CheckpointedFeedPipeline(FeedPipeline):
+    """
+    FeedPipeline that survives bad rows and interrupted runs.
+
+    A row that fails to convert goes to QuarantinedRow with its error
+    instead of aborting the import. Every chunk is committed together with
+    the ImportCheckpoint of the feed, so after a crash the next run for
+    the same feed_name skips straight past the rows already written. A run
+    over a file with a different fingerprint, such as the next night's
+    download, starts from the first row.
+    """
+
+    def __init__(self, feed_name, key_map=CSV_TO_MODEL_FIELD_MAP,
+            chunk_size=IMPORT_CHUNK_SIZE, fingerprint=None):
+        super(CheckpointedFeedPipeline, self).__init__(key_map, chunk_size)
+        self.feed_name = feed_name
+        self.checkpoint, created = ImportCheckpoint.objects.get_or_create(feed_name=feed_name)
+        if (self.checkpoint.finished or fingerprint is None or
+                self.checkpoint.fingerprint != fingerprint):
+            # the last run completed or read another file, this is a new one
+            self.checkpoint.offset = 0
+            self.checkpoint.finished = False
+            self.checkpoint.fingerprint = fingerprint or ""
+            self.checkpoint.save()
+        if self.checkpoint.offset == 0:
+            QuarantinedRow.objects.filter(feed_name=feed_name).delete()
+        self.rows_read = self.checkpoint.offset
+        self.quarantined = []
+
+    def read(self, feed_file, encoding='utf-8'):
+        rows = super(CheckpointedFeedPipeline, self).read(feed_file, encoding)
+        return islice(rows, self.checkpoint.offset, None)
+
+    def coerce(self, rows):
+        for row in rows:
+            self.rows_read += 1
+            try:
+                self.check_row(row)
+                vehicle = Vehicle(**self.plan(row))
+            except (ValueError, KeyError, TypeError) as e:
+                # InvalidFeedValue, a missing column or a short row
+                self.quarantined.append(QuarantinedRow(
+                    feed_name=self.feed_name,
+                    row_number=self.rows_read,
+                    row=json.dumps(row),
+                    error=repr(e),
+                ))
+                continue
+            yield row, vehicle
+
+    # columns the write stage needs a value in
+    REQUIRED_COLUMNS = ('Make', 'Model', 'ModelNumber', 'Body')
+
+    def check_row(self, row):
+        # DictReader fills the cells missing from a short row with None,
+        # which would only fail in the write stage and abort the chunk
+        int(row['Doors'])
+        for key in self.REQUIRED_COLUMNS:
+            if not (row[key] or '').strip():
+                raise InvalidFeedValue('Missing %s' % key)
+        if row['ImageList'] is None:
+            raise InvalidFeedValue('Missing ImageList')
+        for key, field_name in self.plan.copied:
+            if row[key] is None:
+                raise InvalidFeedValue('Missing %s' % key)
+
+    def save_progress(self, finished=False):
+        QuarantinedRow.objects.bulk_create(self.quarantined)
+        self.quarantined = []
+        self.checkpoint.offset = self.rows_read
+        self.checkpoint.finished = finished
+        self.checkpoint.save()
+
+    def write(self, batches):
+        lookups = VehicleLookupCache()
+        for batch in batches:
+            with transaction.atomic():
+                write_vehicle_chunk(batch, lookups)
+                self.save_progress()
+            yield len(batch)
+        with transaction.atomic():
+            self.save_progress(finished=True)
+
+# params:
+# 1. feed_file: <String> path or an open text file
+# returns:
+# <String> sha1 of the file's contents, or None for a file that can't be
+# rewound after reading it
+def feed_fingerprint(feed_file, encoding='utf-8'):
+    digest = hashlib.sha1()
+    if isinstance(feed_file, str):
+        with open(feed_file, 'rb') as feed:
+            for block in iter(partial(feed.read, 1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+    if not feed_file.seekable():
+        return None
+    start = feed_file.tell()
+    for block in iter(partial(feed_file.read, 1 << 20), feed_file.read(0)):
+        digest.update(block.encode(encoding) if isinstance(block, str) else block)
+    feed_file.seek(start)
+    return digest.hexdigest()
+
+# params:
+# 1. feed_file: <String> path or an open text file
+# 2. feed_name: <String> identifies the feed between runs, defaults to the
+#    file name; required when feed_file is an open file
+# returns:
+# <Dict> import_stats plus the number of rows quarantined
+def ingest_feed_resumable(feed_file, feed_name=None, key_map=CSV_TO_MODEL_FIELD_MAP,
+        chunk_size=IMPORT_CHUNK_SIZE):
+    if feed_name is None:
+        if not isinstance(feed_file, str):
+            raise ValueError('feed_name is required when feed_file is an open file')
+        feed_name = os.path.basename(feed_file)
+    pipeline = CheckpointedFeedPipeline(feed_name, key_map, chunk_size,
+            feed_fingerprint(feed_file))
+    stats = pipeline.run(feed_file)
+    stats['quarantined'] = QuarantinedRow.objects.filter(feed_name=feed_name).count()
+    rebuild_similar_vehicle_index()
+    return stats
+
+# params:
+# 1. row: a row of <csv.DictReader>
+# returns:
+# <String> digest of every column in the row, independent of column order
+def row_fingerprint(row):
+    content = '\x1e'.join(
+        key + '\x1f' + (val or '') for key, val in sorted(row.items())
+    )
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+# largest share of the stored inventory one sync may delete; a feed that
+# would remove more is assumed to be truncated
+SYNC_MAX_REMOVED_FRACTION = 0.5
+
+class FeedSyncPipeline(FeedPipeline):
+    """
+    Incremental version of FeedPipeline.
+
+    Vehicles are matched on VIN, which is unique across dealers, and on
+    stock number only when the VIN is blank; they are compared through the fingerprint stored from the last run.
+    Unchanged rows are dropped before coercion, changed rows only write
+    the fields that differ, and vehicles missing from the feed are
+    deleted in bulk once the whole file has been read. Nothing is deleted
+    when the feed had no rows or would remove more than
+    max_removed_fraction of the stored vehicles.
+    """
+
+    STAGES = FeedPipeline.STAGES + ('unchanged', 'created', 'updated', 'removed')
+
+    def __init__(self, key_map=CSV_TO_MODEL_FIELD_MAP, chunk_size=IMPORT_CHUNK_SIZE,
+            max_removed_fraction=SYNC_MAX_REMOVED_FRACTION):
+        super(FeedSyncPipeline, self).__init__(key_map, chunk_size)
+        self.max_removed_fraction = max_removed_fraction
+        self.removal_refused = False
+        self.stale = 0
+        columns = dict((field, col) for col, field in key_map.items())
+        self.stock_column = columns['stock_number']
+        self.vin_column = columns['vin']
+        self.known = {}
+        for pk, stock_number, vin, fingerprint in Vehicle.objects.values_list(
+                'id', 'stock_number', 'vin', 'row_fingerprint'):
+            self.known[self.vehicle_key(vin, stock_number)] = (pk, fingerprint)
+        self.seen = set()
+
+    def vehicle_key(self, vin, stock_number):
+        # stock numbers are only unique within one dealer
+        if vin:
+            return ('vin', vin)
+        return ('stock', stock_number)
+
+    def row_key(self, row):
+        return self.vehicle_key(row.get(self.vin_column), row.get(self.stock_column))
+
+    def coerce(self, rows):
+        for row in rows:
+            key = self.row_key(row)
+            self.seen.add(key)
+            fingerprint = row_fingerprint(row)
+            pk, known_fingerprint = self.known.get(key, (None, None))
+            if fingerprint == known_fingerprint:
+                self.counts['unchanged'] += 1
+                continue
+            vehicle = Vehicle(**self.plan(row))
+            vehicle.pk = pk
+            vehicle.row_fingerprint = fingerprint
+            yield row, vehicle
+
+    def write(self, batches):
+        lookups = VehicleLookupCache()
+        for batch in batches:
+            created = [pair for pair in batch if pair[1].pk is None]
+            changed = [pair for pair in batch if pair[1].pk is not None]
+            with transaction.atomic():
+                if created:
+                    write_vehicle_chunk(created, lookups)
+                if changed:
+                    self.update_vehicles(changed, lookups)
+            self.counts['created'] += len(created)
+            self.counts['updated'] += len(changed)
+            yield len(batch)
+
+    def update_vehicles(self, pairs, lookups):
+        vehicles = resolve_vehicle_relations(pairs, lookups)
+        stored = Vehicle.objects.in_bulk([vehicle.pk for vehicle in vehicles])
+        # only what the feed controls; slug and short_url are kept
+        feed_fields = set(self.plan.field_names())
+        feed_fields.update(['make_id', 'body_id', 'model_id', 'row_fingerprint'])
+        fields = [
+            field for field in Vehicle._meta.concrete_fields
+            if field.attname in feed_fields
+        ]
+        options_changed = []
+        for vehicle in vehicles:
+            current = stored[vehicle.pk]
+            changed = {}
+            for field in fields:
+                val = field.to_python(getattr(vehicle, field.attname))
+                if val != getattr(current, field.attname):
+                    changed[field.attname] = val
+            Vehicle.objects.filter(pk=vehicle.pk).update(**changed)
+            if 'categorized_options' in changed:
+                options_changed.append(vehicle)
+        index_vehicle_options(options_changed, replace=True)
+
+        sync_vehicle_images([
+            (vehicle.pk, image_urls_from_row(row)) for row, vehicle in pairs
+        ])
+
+    def remove_stale(self):
+        # units that dropped out of the feed have been sold
+        stale = [pk for key, (pk, fingerprint) in self.known.items() if key not in self.seen]
+        self.stale = len(stale)
+        if stale and (not self.seen or
+                len(stale) > len(self.known) * self.max_removed_fraction):
+            # an empty or cut off download would otherwise wipe the inventory
+            print('Refusing to remove %d of %d vehicles missing from the feed'
+                    % (len(stale), len(self.known)))
+            self.removal_refused = True
+            return
+        for chunk in iter_chunks(stale, self.chunk_size):
+            Vehicle.objects.filter(id__in=chunk).delete()
+        self.counts['removed'] = len(stale)
+
+    def run_rows(self, rows):
+        started = time.time()
+        stats = super(FeedSyncPipeline, self).run_rows(rows)
+        self.remove_stale()
+        bump_inventory_version()
+        stats = import_stats(stats['rows'], time.time() - started)
+        for stage in ('unchanged', 'created', 'updated', 'removed'):
+            stats[stage] = self.counts[stage]
+        stats['stale'] = self.stale
+        stats['removal_refused'] = self.removal_refused
+        return stats
+
+# params:
+# 1. feed_file: <String> path or an open text file
+# 2. chunk_size: <Int> rows held in memory and written per transaction
+# 3. max_removed_fraction: <Float> share of the inventory a sync may delete
+# returns:
+# <Dict> import_stats plus unchanged, created, updated, removed and stale
+# counts, and removal_refused when the stale vehicles were kept
+def sync_feed(feed_file, key_map=CSV_TO_MODEL_FIELD_MAP,
+        chunk_size=IMPORT_CHUNK_SIZE, max_removed_fraction=SYNC_MAX_REMOVED_FRACTION):
+    stats = FeedSyncPipeline(key_map, chunk_size, max_removed_fraction).run(feed_file)
+    rebuild_similar_vehicle_index()
+    return stats
+
+# params:
+# 1. rows: <Iterable> of <csv.DictReader> rows
+# 2. key_map: <Dict>
+# 3. chunk_size: <Int> rows written per transaction
+# returns:
+# <Dict> with rows imported, seconds taken and rows_per_sec
+def bulk_import_csv_rows(rows, key_map=CSV_TO_MODEL_FIELD_MAP,
+        chunk_size=IMPORT_CHUNK_SIZE):
+    return FeedPipeline(key_map, chunk_size).run_rows(rows)
+
+# params:
+# 1. feed_file: <String> path or an open text file
+# 2. chunk_size: <Int> rows held in memory and written per transaction
+# 3. workers: <Int> coercion processes, 0 for one per core,
+#    None to coerce in this process
+# returns:
+# <Dict> with rows imported, seconds taken and rows_per_sec
+def ingest_feed(feed_file, key_map=CSV_TO_MODEL_FIELD_MAP,
+        chunk_size=IMPORT_CHUNK_SIZE, workers=None):
+    if workers is None:
+        stats = FeedPipeline(key_map, chunk_size).run(feed_file)
+    else:
+        stats = ProcessFeedPipeline(key_map, chunk_size, workers).run(feed_file)
+    rebuild_similar_vehicle_index()
+    return stats
+
+# params:
+# 1. count: <Int> rows processed
+# 2. seconds: <Float>
+# returns:
+# <Dict> suitable for comparing import runs
+def import_stats(count, seconds):
+    return {
+        'rows': count,
+        'seconds': seconds,
+        'rows_per_sec': count / seconds if seconds else 0.0,
+    }
+
 class VehicleMake(models.Model):
-    name = models.CharField(max_length=100)
+    name = models.CharField(max_length=100, db_index=True)
 
     def __str__(self):
         return self.name
@@ -213,6 +1063,36 @@ class VehicleModel(models.Model):
     def __str__(self):
         return self.make.name + ' ' +self.number + '-' + self.name
 
+class LRUCache(object):
+
+    def __init__(self, max_size=5000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.entries.move_to_end(key)
+            except KeyError:
+                return default
+            return self.entries[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+# short links by vehicle url, so a changed slug never gets a stale link;
+# bounded, since inventory keeps turning over in long lived processes
+short_url_cache = LRUCache()
+
 def flatten_values_list(values_qs):
     return [val[0] for val in values_qs]
 
@@ -241,6 +1121,16 @@ class VehicleManager(models.Manager):
     def new_specials(self):
         return self.specials().filter(is_new=True)
 
+    def with_option(self, category, option):
+        return self.filter(id__in=VehicleOption.objects.vehicle_ids(category, option))
+
+    def with_options(self, options):
+        # options: (category, option) pairs, all of which must be present
+        qs = self.all()
+        for category, option in options:
+            qs = qs.filter(id__in=VehicleOption.objects.vehicle_ids(category, option))
+        return qs
+
 class Vehicle(models.Model):
 
     INT_FIELDS = [
@@ -269,7 +1159,7 @@ class Vehicle(models.Model):
     ]
 
     is_new = models.BooleanField(verbose_name="New")
-    stock_number = models.CharField(max_length=20, verbose_name="Stock")
+    stock_number = models.CharField(max_length=20, verbose_name="Stock", db_index=True)
     vin = models.CharField(max_length=20, verbose_name="VIN")
     year_mfd = models.PositiveIntegerField(verbose_name="Year")
     make = models.ForeignKey(VehicleMake)
@@ -284,14 +1174,16 @@ class Vehicle(models.Model):
     transmission = models.CharField(max_length=20)
     miles = models.PositiveIntegerField()
     selling_price = models.PositiveIntegerField()
-    msrp = models.PositiveIntegerField(verbose_name="MSRP")
+    msrp = models.PositiveIntegerField(verbose_name="MSRP", db_index=True)
     book_value = models.PositiveIntegerField()
     invoice = models.PositiveIntegerField()
     certified = models.BooleanField()
-    date_in_stock = models.DateField()
+    date_in_stock = models.DateField(db_index=True)
     description = models.TextField()
     options = models.TextField()
     cat_options = models.TextField(verbose_name="Categorized options")
+    # cat_options parsed into json by the importer
+    categorized_options = models.TextField(blank=True)
     special_field1 = models.CharField(max_length=100, blank=True)
     special_field2 = models.CharField(max_length=100, blank=True)
     special_field3 = models.CharField(max_length=100, blank=True)
@@ -322,9 +1214,20 @@ class Vehicle(models.Model):
     passenger_capacity = models.PositiveIntegerField()
     disp_cub_inches = models.FloatField(verbose_name="Displacement in Cubic Inches")
     slug = models.SlugField(max_length=200, unique=True)
+    # digest of the feed row this vehicle was last written from
+    row_fingerprint = models.CharField(max_length=40, blank=True)
+    short_url = models.URLField(blank=True)
 
     objects = VehicleManager()
 
+    class Meta:
+        index_together = [
+            # new(), used() and the *_specials() date range
+            ('is_new', 'date_in_stock'),
+            # dch_certified() and acura_certified()
+            ('is_new', 'certified', 'make'),
+        ]
+
     def __str__(self):
         return self.stock_number + ' ' + str(self.model)
 
@@ -333,26 +1236,16 @@ class Vehicle(models.Model):
         return self.vehicleimage_set.first().url
 
     def get_categorized_options(self):
-        cats = {}
-        for cat_opt in self.cat_options.split('~'):
-            cat, opt = cat_opt.split('@')
-            try:
-                cats[cat].append(opt)
-            except KeyError as e:
-                cats[cat] = [opt]
-        return cats
+        # parsed at import time and stored as json in categorized_options
+        if not self.categorized_options:
+            return parse_categorized_options(self.cat_options)
+        return json.loads(self.categorized_options)
 
     def get_similar_vehicles(self):
-        if self.is_new and self.model.vehicle_set.exclude(id=self.id).count() > 0:
-            qs = self.model.vehicle_set.exclude(id=self.id)
-        else:
-            LOOKUP_WINDOW = 50
-            qs = Vehicle.objects.filter(
-                msrp__lte=self.msrp+LOOKUP_WINDOW,
-                msrp__gte=self.msrp-LOOKUP_WINDOW,
-            ).exclude(id=self.id)
-
-        return qs[:6]
+        ids = get_similar_vehicle_index().similar_ids(
+            self.id, self.is_new, self.model_id, self.msrp
+        )
+        return Vehicle.objects.filter(id__in=ids)
 
     def get_absolute_url(self):
         return reverse('vehicle_details', kwargs={
@@ -360,19 +1253,50 @@ class Vehicle(models.Model):
             'slug':self.slug
         })
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        vehicle = super(Vehicle, cls).from_db(db, field_names, values)
+        # what the stored short_url was made for
+        vehicle.loaded_slug = vehicle.__dict__.get('slug')
+        return vehicle
+
     def get_shortened_url(self):
+        """
+            Served from memory, then from the short_url column, and only
+            asks the shortener when neither has a link for this slug yet
+        """
+        long_path = self.get_absolute_url()
+        short_url = short_url_cache.get(long_path)
+        if short_url is None:
+            short_url = self.short_url
+            if not short_url and self.pk is not None:
+                # the link may have been primed since this instance, or the
+                # stock index entry it came from, was loaded
+                short_url = Vehicle.objects.filter(pk=self.pk).values_list(
+                    'short_url', flat=True).first() or ""
+            if not short_url:
+                short_url = self.request_short_url(long_path)
+                Vehicle.objects.filter(pk=self.pk, short_url="").update(short_url=short_url)
+            self.short_url = short_url
+            short_url_cache.set(long_path, short_url)
+        return short_url
+
+    def request_short_url(self, long_path):
         api_url = settings.GOOGLE_API_ENDPOINT + settings.GOOGL_URLSHORTENER_APIKEY
         headers = {
             'Content-Type':'application/json',
         }
         body = json.dumps({
-            'longUrl': settings.SITE_URL + self.get_absolute_url()
+            'longUrl': settings.SITE_URL + long_path
         })
-        resp = requests.post(api_url, data=body, headers=headers).json()
+        resp = get_shortener().post(api_url, data=body, headers=headers).json()
         return resp['id']
 
-    def handlebars_context(self):
-        return json.dumps({
+    # params:
+    # 1. thumbnail: <String> url of the first image when the caller has
+    #    already loaded it, so no query is made for it
+    def handlebars_dict(self, thumbnail=None):
+        return {
             'stock_number': self.stock_number,
             'make': self.make.id,
             'model': self.model.id,
@@ -381,18 +1305,457 @@ class Vehicle(models.Model):
             'vin': self.vin,
             'year_mfd': self.year_mfd,
             'body': self.body.name,
-            'thumbnail': self.thumbnail,
+            'thumbnail': self.thumbnail if thumbnail is None else thumbnail,
             'trim': self.trim,
+        }
+
+    def handlebars_context(self):
+        if self.id is None:
+            return json.dumps(self.handlebars_dict())
+        return cached_vehicle_payload(self.id, 'handlebars', self)
+
+    def detail_dict(self):
+        context = self.handlebars_dict()
+        context.update({
+            'url': self.get_absolute_url(),
+            'is_new': self.is_new,
+            'certified': self.certified,
+            'msrp': self.msrp,
+            'selling_price': self.selling_price,
+            'internet_price': self.internet_price,
+            'miles': self.miles,
+            'exterior_color': self.exterior_color,
+            'interior_color': self.interior_color,
+            'transmission': self.transmission,
+            'drive_train': self.drive_train,
+            'fuel': self.fuel,
+            'city_mpg': self.city_mpg,
+            'highway_mpg': self.highway_mpg,
+            'description': self.description,
+            'categorized_options': self.get_categorized_options(),
+            'images': [image.url for image in self.vehicleimage_set.all()],
         })
+        return context
+
+    def detail_payload(self):
+        return cached_vehicle_payload(self.id, 'detail', self)
 
     def save(self, *args, **kwargs):
         if (self.slug == "") or (self.slug is None) :
-            slug_input = "vehicle " + self.make.name + " " + self.model.name
-            slug_input += " " + str(self.year_mfd)
-            slug_input += " Verona NJ "
-            slug_input += self.stock_number
-            self.slug = slugify(slug_input)[:200] # truncate to field size
+            slug = vehicle_slug(
+                self.make.name, self.model.name, self.year_mfd, self.stock_number
+            )
+            self.slug = SlugAllocator.for_slug(slug).allocate(slug)
+        self.categorized_options = categorized_options_json(self.cat_options)
+        if getattr(self, 'loaded_slug', self.slug) != self.slug:
+            # the short link points at the old slug
+            self.short_url = ""
         super(Vehicle, self).save(*args, **kwargs)
+        self.loaded_slug = self.slug
+        index_vehicle_options([self], replace=True)
+        bump_inventory_version()
+
+# params:
+# 1. vehicle_ids: <List> of <Int>
+# returns:
+# <Dict> vehicle id -> url of its first image, in a single query
+def first_image_urls(vehicle_ids):
+    first_ids = VehicleImage.objects.filter(
+        vehicle_id__in=vehicle_ids
+    ).values('vehicle').annotate(first_id=models.Min('id')).values('first_id')
+    return dict(VehicleImage.objects.filter(id__in=first_ids).values_list('vehicle_id', 'url'))
+
+# params:
+# 1. queryset: <QuerySet> of Vehicle, e.g. Vehicle.objects.specials()
+# returns:
+# <List> of handlebars_dict()s, built with two queries however many
+# vehicles there are
+def handlebars_dicts(queryset):
+    vehicles = list(queryset.select_related('make', 'model', 'body'))
+    thumbnails = first_image_urls([vehicle.id for vehicle in vehicles])
+    return [
+        vehicle.handlebars_dict(thumbnails.get(vehicle.id, ''))
+        for vehicle in vehicles
+    ]
+
+# params:
+# 1. queryset: <QuerySet> of Vehicle
+# 2. chunk_size: <Int> vehicles serialized per pair of queries
+# returns:
+# generator of json text that together forms the list of contexts,
+# e.g. for a StreamingHttpResponse
+def iter_handlebars_json(queryset, chunk_size=200):
+    yield '['
+    vehicles = queryset.select_related('make', 'model', 'body').iterator()
+    separator = ''
+    for chunk in iter_chunks(vehicles, chunk_size):
+        thumbnails = first_image_urls([vehicle.id for vehicle in chunk])
+        for vehicle in chunk:
+            yield separator + json.dumps(vehicle.handlebars_dict(thumbnails.get(vehicle.id, '')))
+            separator = ','
+    yield ']'
+
+# column lengths of VehicleOption; longer feed values are cut to fit
+OPTION_CATEGORY_LENGTH = 100
+OPTION_NAME_LENGTH = 255
+
+class VehicleOptionManager(models.Manager):
+
+    def vehicle_ids(self, category, option):
+        # cut like index_vehicle_options stores them, so long values still match
+        return self.filter(category=category[:OPTION_CATEGORY_LENGTH],
+                name=option[:OPTION_NAME_LENGTH]).values('vehicle_id')
+
+    def facet_counts(self, category=None):
+        # (category, option) -> number of vehicles offering it
+        qs = self.all() if category is None else self.filter(category=category)
+        return dict(
+            ((row['category'], row['name']), row['vehicles'])
+            for row in qs.values('category', 'name').annotate(vehicles=models.Count('vehicle'))
+        )
+
+class VehicleOption(models.Model):
+    # inverted index of categorized options, one row per vehicle and option
+    vehicle = models.ForeignKey(Vehicle)
+    category = models.CharField(max_length=OPTION_CATEGORY_LENGTH)
+    name = models.CharField(max_length=OPTION_NAME_LENGTH)
+
+    objects = VehicleOptionManager()
+
+    class Meta:
+        index_together = [('category', 'name')]
+
+    def __str__(self):
+        return self.category + ': ' + self.name
+
+# params:
+# 1. vehicles: <List> of saved <Vehicle>s
+# 2. replace: <Boolean> drop the rows already indexed for these vehicles
+def index_vehicle_options(vehicles, replace=False):
+    if replace and vehicles:
+        VehicleOption.objects.filter(vehicle_id__in=[vehicle.pk for vehicle in vehicles]).delete()
+    options = []
+    for vehicle in vehicles:
+        for category, names in vehicle.get_categorized_options().items():
+            category = category[:OPTION_CATEGORY_LENGTH]
+            for name in set(name[:OPTION_NAME_LENGTH] for name in names):
+                options.append(VehicleOption(vehicle_id=vehicle.pk, category=category, name=name))
+    VehicleOption.objects.bulk_create(options, batch_size=IMPORT_CHUNK_SIZE)
+
+# Parses and indexes every vehicle stored before the option index existed
+def rebuild_option_index(chunk_size=IMPORT_CHUNK_SIZE):
+    vehicles = Vehicle.objects.only('id', 'cat_options', 'categorized_options').iterator()
+    for chunk in iter_chunks(vehicles, chunk_size):
+        with transaction.atomic():
+            for vehicle in chunk:
+                if not vehicle.categorized_options:
+                    vehicle.categorized_options = categorized_options_json(vehicle.cat_options)
+                    Vehicle.objects.filter(pk=vehicle.pk).update(
+                        categorized_options=vehicle.categorized_options
+                    )
+            index_vehicle_options(chunk, replace=True)
+
+class SimilarVehicleIndex(object):
+    """
+    Answers get_similar_vehicles from memory. New vehicles get other
+    vehicles of the same model, anything else (or a new vehicle alone in
+    its model) gets vehicles priced within LOOKUP_WINDOW of its MSRP.
+    MSRPs are kept sorted so the window is found with bisect, and both
+    cases return the lowest ids, as the unordered queries used to.
+    """
+
+    LOOKUP_WINDOW = 50
+
+    # params:
+    # 1. rows: <Iterable> of (id, msrp, model_id) tuples
+    def __init__(self, rows, version=None):
+        rows = sorted(rows, key=itemgetter(1, 0))
+        self.msrps = [msrp for pk, msrp, model_id in rows]
+        self.msrp_ids = [pk for pk, msrp, model_id in rows]
+        self.by_model = {}
+        for pk, msrp, model_id in rows:
+            self.by_model.setdefault(model_id, []).append(pk)
+        for ids in self.by_model.values():
+            ids.sort()
+        self.version = get_inventory_version() if version is None else version
+
+    @classmethod
+    def build(cls):
+        # the version is read before the rows, so a bump while they load
+        # leaves the index marked stale rather than current
+        version = get_inventory_version()
+        return cls(Vehicle.objects.values_list('id', 'msrp', 'model_id'), version)
+
+    def similar_ids(self, vehicle_id, is_new, model_id, msrp, limit=6):
+        if is_new:
+            same_model = self.by_model.get(model_id, ())
+            ids = list(islice((pk for pk in same_model if pk != vehicle_id), limit))
+            if ids:
+                return ids
+        lo = bisect_left(self.msrps, msrp - self.LOOKUP_WINDOW)
+        hi = bisect_right(self.msrps, msrp + self.LOOKUP_WINDOW)
+        return heapq.nsmallest(
+            limit, (pk for pk in self.msrp_ids[lo:hi] if pk != vehicle_id)
+        )
+
+similar_vehicle_index = None
+
+def rebuild_similar_vehicle_index():
+    global similar_vehicle_index
+    similar_vehicle_index = SimilarVehicleIndex.build()
+    return similar_vehicle_index
+
+def get_similar_vehicle_index():
+    index = similar_vehicle_index
+    if index is None or index.version != get_inventory_version():
+        index = rebuild_similar_vehicle_index()
+    return index
+
+# params:
+# 1. positions: <Iterable> of <Int> bit positions
+# returns:
+# <Int> bitmap with those bits set, built in one pass
+def bitmap_from_positions(positions):
+    positions = list(positions)
+    if not positions:
+        return 0
+    buf = bytearray(max(positions) // 8 + 1)
+    for position in positions:
+        buf[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(bytes(buf), 'little')
+
+def bit_positions(bits):
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+class FacetSelection(object):
+    """
+    A set of vehicles in an InventoryFacetIndex. filter/exclude intersect
+    bitmaps and return a new selection, so combined filters chain like
+    querysets without touching the database.
+    """
+
+    def __init__(self, index, bits):
+        self.index = index
+        self.bits = bits
+
+    def filter(self, **facets):
+        bits = self.bits
+        for facet, value in facets.items():
+            bits &= self.index.facet_bits(facet, value)
+        return FacetSelection(self.index, bits)
+
+    def exclude(self, **facets):
+        bits = self.bits
+        for facet, value in facets.items():
+            bits &= ~self.index.facet_bits(facet, value)
+        return FacetSelection(self.index, bits)
+
+    def count(self):
+        return bin(self.bits).count('1')
+
+    def ids(self, limit=None):
+        ids = (self.index.ids[position] for position in bit_positions(self.bits))
+        return list(ids if limit is None else islice(ids, limit))
+
+    def facet_counts(self, facet):
+        return dict(
+            (value, bin(self.bits & bits).count('1'))
+            for value, bits in self.index.facets[facet].items()
+            if self.bits & bits
+        )
+
+    def queryset(self):
+        return Vehicle.objects.filter(id__in=self.ids())
+
+class InventoryFacetIndex(object):
+    """
+    One bitmap per facet value, a bit per vehicle, so any mix of make,
+    body, model, year, price band, new/used and certified filters is a few
+    big-int ANDs. Offers the same helpers as VehicleManager, returning
+    FacetSelections. Vehicles can be refreshed in place; their old bits
+    are cleared and they get a new position.
+    """
+
+    FACETS = ('make', 'body', 'model', 'year', 'price_band', 'is_new', 'certified')
+    PRICE_BAND = 5000
+    VALUES = ('id', 'make__name', 'body__name', 'model__name', 'year_mfd',
+              'selling_price', 'is_new', 'certified', 'date_in_stock')
+
+    def __init__(self, rows, version=None):
+        self.ids = []
+        self.positions = {}
+        self.row_facets = []
+        self.in_stock = []
+        self.live = 0
+        self.facets = dict((facet, {}) for facet in self.FACETS)
+        self.specials_cache = (None, 0)
+        facet_positions = dict((facet, {}) for facet in self.FACETS)
+        for row in rows:
+            position = self.place(row)
+            for facet, value in self.row_facets[position].items():
+                facet_positions[facet].setdefault(value, []).append(position)
+        for facet, values in facet_positions.items():
+            for value, positions in values.items():
+                self.facets[facet][value] = bitmap_from_positions(positions)
+        self.live = bitmap_from_positions(range(len(self.ids)))
+        self.version = get_inventory_version() if version is None else version
+
+    @classmethod
+    def build(cls):
+        version = get_inventory_version()
+        return cls(Vehicle.objects.values(*cls.VALUES).iterator(), version)
+
+    def row_to_facets(self, row):
+        return {
+            'make': row['make__name'],
+            'body': row['body__name'],
+            'model': row['model__name'],
+            'year': row['year_mfd'],
+            'price_band': row['selling_price'] // self.PRICE_BAND * self.PRICE_BAND,
+            'is_new': row['is_new'],
+            'certified': row['certified'],
+        }
+
+    def place(self, row):
+        position = len(self.ids)
+        self.ids.append(row['id'])
+        self.positions[row['id']] = position
+        self.row_facets.append(self.row_to_facets(row))
+        self.in_stock.append(row['date_in_stock'])
+        return position
+
+    def facet_bits(self, facet, value):
+        return self.facets[facet].get(value, 0)
+
+    def remove(self, vehicle_id):
+        position = self.positions.pop(vehicle_id, None)
+        if position is None:
+            return
+        mask = ~(1 << position)
+        self.live &= mask
+        for facet, value in self.row_facets[position].items():
+            self.facets[facet][value] &= mask
+        self.specials_cache = (None, 0)
+
+    # params:
+    # 1. vehicle_ids: <List> of ids changed, added or deleted since the build
+    def refresh(self, vehicle_ids):
+        for vehicle_id in vehicle_ids:
+            self.remove(vehicle_id)
+        for row in Vehicle.objects.filter(id__in=vehicle_ids).values(*self.VALUES):
+            position = self.place(row)
+            bit = 1 << position
+            self.live |= bit
+            for facet, value in self.row_facets[position].items():
+                self.facets[facet][value] = self.facet_bits(facet, value) | bit
+        self.specials_cache = (None, 0)
+
+    def all(self):
+        return FacetSelection(self, self.live)
+
+    def filter(self, **facets):
+        return self.all().filter(**facets)
+
+    def new(self):
+        return self.filter(is_new=True)
+
+    def used(self):
+        return self.filter(is_new=False)
+
+    def dch_certified(self):
+        return self.filter(is_new=False, certified=True).exclude(make='Acura')
+
+    def acura_certified(self):
+        return self.filter(is_new=False, certified=True, make='Acura')
+
+    def specials(self):
+        # same 45 day cutoff as VehicleManager.specials
+        cutoff = (datetime.today() - timedelta(days=45)).date()
+        cached_cutoff, bits = self.specials_cache
+        if cached_cutoff != cutoff:
+            bits = self.live & bitmap_from_positions(
+                position for position, in_stock in enumerate(self.in_stock)
+                if in_stock <= cutoff
+            )
+            self.specials_cache = (cutoff, bits)
+        return FacetSelection(self, bits)
+
+    def used_specials(self):
+        return self.specials().filter(is_new=False)
+
+    def new_specials(self):
+        return self.specials().filter(is_new=True)
+
+inventory_facet_index = None
+
+def get_inventory_facet_index():
+    global inventory_facet_index
+    index = inventory_facet_index
+    if index is None or index.version != get_inventory_version():
+        index = inventory_facet_index = InventoryFacetIndex.build()
+    return index
+
+# make or model of a StockEntry, with the id and name the lead forms use
+IndexedChoice = namedtuple('IndexedChoice', 'id name')
+
+class StockEntry(namedtuple('StockEntry', [
+        'id', 'stock_number', 'vin', 'year_mfd', 'make', 'model', 'slug', 'short_url'])):
+
+    def vehicle(self):
+        # unsaved stand-in, enough for get_absolute_url and get_shortened_url;
+        # a blank short_url is re-read from the column before one is requested
+        return Vehicle(id=self.id, stock_number=self.stock_number, vin=self.vin,
+                year_mfd=self.year_mfd, make_id=self.make.id, model_id=self.model.id,
+                slug=self.slug, short_url=self.short_url)
+
+class StockIndex(object):
+    """
+    stock_number -> StockEntry for the whole inventory, so lead forms and
+    ADF building need no inventory queries. A stock number missing from
+    the index is looked up once in the database and added, which keeps
+    vehicles imported since the last rebuild working.
+    """
+
+    VALUES = ('id', 'stock_number', 'vin', 'year_mfd', 'make_id', 'make__name',
+              'model_id', 'model__name', 'slug', 'short_url')
+
+    def __init__(self, rows, version=None):
+        self.entries = {}
+        for row in rows:
+            self.add(row)
+        self.version = get_inventory_version() if version is None else version
+
+    @classmethod
+    def build(cls):
+        version = get_inventory_version()
+        return cls(Vehicle.objects.values_list(*cls.VALUES).iterator(), version)
+
+    def add(self, row):
+        pk, stock_number, vin, year_mfd, make_id, make_name, model_id, model_name, slug, short_url = row
+        entry = StockEntry(pk, stock_number, vin, year_mfd,
+                IndexedChoice(make_id, make_name), IndexedChoice(model_id, model_name),
+                slug, short_url)
+        self.entries[stock_number] = entry
+        return entry
+
+    def lookup(self, stock_number):
+        try:
+            return self.entries[stock_number]
+        except KeyError:
+            row = Vehicle.objects.filter(stock_number=stock_number).values_list(*self.VALUES).first()
+            return None if row is None else self.add(row)
+
+stock_index = None
+
+def get_stock_index():
+    global stock_index
+    index = stock_index
+    if index is None or index.version != get_inventory_version():
+        index = stock_index = StockIndex.build()
+    return index
 
 class VehicleImage(models.Model):
     # array of images
@@ -401,3 +1764,378 @@ class VehicleImage(models.Model):
 
     def __str__(self):
         return self.url
+
+INVENTORY_VERSION_KEY = 'inventory:version'
+# serialized vehicle payloads of this process, keyed by kind, inventory
+# version and vehicle id; a version bump makes every entry unreachable
+vehicle_payloads = LRUCache()
+# seconds a process trusts the version it last read from InventoryVersion
+INVENTORY_VERSION_TTL = 5
+local_inventory_version = {'version': None, 'read_at': 0}
+
+class InventoryVersion(models.Model):
+    # the one row holding the inventory version when no shared cache is
+    # configured, so a bump in the import process reaches the web processes
+    version = models.PositiveIntegerField(default=1)
+
+# returns:
+# the Django cache named by ADF_INVENTORY_CACHE, or None to keep the
+# inventory version in the database and payloads in this process only
+def get_inventory_cache():
+    alias = getattr(settings, 'ADF_INVENTORY_CACHE', None)
+    return caches[alias] if alias else None
+
+def get_inventory_version():
+    cache = get_inventory_cache()
+    if cache is None:
+        if time.monotonic() - local_inventory_version['read_at'] >= INVENTORY_VERSION_TTL:
+            row, created = InventoryVersion.objects.get_or_create(pk=1)
+            local_inventory_version['version'] = row.version
+            local_inventory_version['read_at'] = time.monotonic()
+        return local_inventory_version['version']
+    version = cache.get(INVENTORY_VERSION_KEY)
+    if version is None:
+        cache.add(INVENTORY_VERSION_KEY, 1, None)
+        version = cache.get(INVENTORY_VERSION_KEY, 1)
+    return version
+
+# Called whenever vehicles are written, so every cached payload and
+# in-memory index built from older data is dropped
+def bump_inventory_version():
+    cache = get_inventory_cache()
+    if cache is None:
+        if not InventoryVersion.objects.filter(pk=1).update(version=models.F('version') + 1):
+            InventoryVersion.objects.get_or_create(pk=1, defaults={'version': 2})
+        # this process sees its own bump straight away
+        local_inventory_version['read_at'] = 0
+        return get_inventory_version()
+    try:
+        return cache.incr(INVENTORY_VERSION_KEY)
+    except ValueError:
+        # the version expired from the cache, start over from a new one
+        cache.add(INVENTORY_VERSION_KEY, 1, None)
+        return cache.incr(INVENTORY_VERSION_KEY)
+
+PAYLOAD_BUILDERS = {
+    'handlebars': Vehicle.handlebars_dict,
+    'detail': Vehicle.detail_dict,
+}
+
+# params:
+# 1. vehicle_id: <Int>
+# 2. kind: <String> a key of PAYLOAD_BUILDERS
+# 3. vehicle: <Vehicle> already loaded, used on a miss instead of a query
+# returns:
+# <String> the payload serialized as json
+def cached_vehicle_payload(vehicle_id, kind, vehicle=None):
+    key = 'vehicle:%s:%s:%s' % (kind, get_inventory_version(), vehicle_id)
+    payload = vehicle_payloads.get(key)
+    if payload is not None:
+        return payload
+    cache = get_inventory_cache()
+    if cache is not None:
+        payload = cache.get(key)
+    if payload is None:
+        if vehicle is None:
+            vehicle = Vehicle.objects.select_related('make', 'model', 'body').get(pk=vehicle_id)
+        payload = json.dumps(PAYLOAD_BUILDERS[kind](vehicle))
+        if cache is not None:
+            cache.set(key, payload)
+    vehicle_payloads.set(key, payload)
+    return payload
+
+def cached_handlebars_context(vehicle_id):
+    return cached_vehicle_payload(vehicle_id, 'handlebars')
+
+def cached_detail_payload(vehicle_id):
+    return cached_vehicle_payload(vehicle_id, 'detail')
+
+class ImportCheckpoint(models.Model):
+    # how far the last run of a feed got
+    feed_name = models.CharField(max_length=200, unique=True)
+    offset = models.PositiveIntegerField(default=0) # rows committed
+    fingerprint = models.CharField(max_length=40, blank=True) # of the file offset is into
+    finished = models.BooleanField(default=False)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.feed_name + ' @ ' + str(self.offset)
+
+class QuarantinedRow(models.Model):
+    # a feed row the importer couldn't convert, kept for fixing by hand
+    feed_name = models.CharField(max_length=200, db_index=True)
+    row_number = models.PositiveIntegerField()
+    row = models.TextField() # json of the csv row
+    error = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.feed_name + ' row ' + str(self.row_number)
+
+# Fills in short_url for every vehicle that doesn't have one yet. A
+# vehicle whose link can't be made is logged and left for the next pass;
+# the pass stops early once the shortener's circuit is open.
+# returns:
+# <Int> number of links created
+def prime_short_urls():
+    created = 0
+    missing = Vehicle.objects.filter(short_url="").only('id', 'stock_number', 'slug', 'short_url')
+    for vehicle in missing.iterator():
+        try:
+            vehicle.get_shortened_url()
+        except UpstreamUnavailable as e:
+            print('Stopped priming short urls: ' + str(e))
+            break
+        except Exception as e:
+            print('Could not shorten the url of ' + vehicle.stock_number + ': ' + repr(e))
+            continue
+        created += 1
+    return created
+
+# params:
+# 1. poll_interval: <Int> seconds between passes over the inventory
+# Runs forever next to the importer, so links for newly imported vehicles
+# are made outside both the import and the request that first needs them.
+def run_short_url_worker(poll_interval=60):
+    while True:
+        try:
+            prime_short_urls()
+        except Exception as e:
+            print('Short url worker error: ' + repr(e))
+        time.sleep(poll_interval)
+
+# lead emails are given up on after this many failed deliveries
+LEAD_OUTBOX_MAX_ATTEMPTS = 8
+# seconds before the first retry, doubled on every further failure
+LEAD_OUTBOX_RETRY_DELAY = 30
+LEAD_OUTBOX_BATCH_SIZE = 50
+# seconds a claimed lead stays hidden from other workers while it is sent
+LEAD_OUTBOX_LEASE = 600
+
+class LeadOutboxManager(models.Manager):
+
+    def pending(self):
+        return self.filter(sent_at__isnull=True, attempts__lt=LEAD_OUTBOX_MAX_ATTEMPTS)
+
+    def due(self):
+        return self.pending().filter(next_attempt_at__lte=now()).order_by('id')
+
+    def failed(self):
+        return self.filter(sent_at__isnull=True, attempts__gte=LEAD_OUTBOX_MAX_ATTEMPTS)
+
+    def depth(self):
+        return self.pending().count()
+
+class LeadOutbox(models.Model):
+    # a serialized ADF lead waiting to be mailed to the CRM
+    subject = models.CharField(max_length=200)
+    body = models.TextField()
+    from_email = models.CharField(max_length=254)
+    to_email = models.CharField(max_length=254)
+    created = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=now, db_index=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    # Lead fields, copied into the Lead table by the worker
+    form_type = models.CharField(max_length=20, blank=True)
+    lead_data = models.TextField(blank=True)
+    lead_recorded = models.BooleanField(default=False, db_index=True)
+
+    objects = LeadOutboxManager()
+
+    def __str__(self):
+        return self.subject + ' to ' + self.to_email
+
+    def as_email(self, connection):
+        return EmailMessage(self.subject, self.body, self.from_email,
+                [self.to_email], connection=connection)
+
+    def record_failure(self, error):
+        self.attempts += 1
+        self.last_error = repr(error)
+        self.next_attempt_at = now() + timedelta(
+            seconds=LEAD_OUTBOX_RETRY_DELAY * 2 ** (self.attempts - 1)
+        )
+        self.save(update_fields=['attempts', 'last_error', 'next_attempt_at'])
+
+class LeadManager(models.Manager):
+
+    def for_phone(self, phone):
+        return self.filter(phone=phone)
+
+    def for_email(self, email):
+        return self.filter(email=email.lower())
+
+    def for_vin(self, vin):
+        return self.filter(vin=vin)
+
+    def between(self, start, end):
+        return self.filter(created__gte=start, created__lt=end)
+
+class Lead(models.Model):
+
+    FORM_TYPES = (
+        ('contact', 'Contact'),
+        ('test-drive', 'Test Drive'),
+        ('quote', 'Request for Quotation'),
+        ('info', 'Request for Information'),
+        ('availability', 'Confirm Availability'),
+        ('finance', 'Finance Enquiry'),
+        ('send-to-mobile', 'Send To Mobile'),
+    )
+
+    # cleaned_data keys stored in their own column, the rest go to extra
+    DIRECT_FIELDS = [
+        'first_name',
+        'last_name',
+        'email',
+        'phone',
+        'address',
+        'city',
+        'state',
+        'zip_code',
+        'message',
+        'stock_number',
+        'vin',
+        'year_mfd',
+    ]
+
+    form_type = models.CharField(max_length=20, choices=FORM_TYPES)
+    created = models.DateTimeField(default=now, db_index=True)
+    first_name = models.CharField(max_length=100, blank=True)
+    last_name = models.CharField(max_length=100, blank=True)
+    email = models.CharField(max_length=254, blank=True, db_index=True)
+    phone = models.CharField(max_length=20, blank=True, db_index=True)
+    address = models.CharField(max_length=200, blank=True)
+    city = models.CharField(max_length=100, blank=True)
+    state = models.CharField(max_length=2, blank=True)
+    zip_code = models.CharField(max_length=10, blank=True)
+    message = models.TextField(blank=True)
+    stock_number = models.CharField(max_length=20, blank=True, db_index=True)
+    vin = models.CharField(max_length=20, blank=True, db_index=True)
+    year_mfd = models.PositiveIntegerField(null=True, blank=True)
+    make_name = models.CharField(max_length=100, blank=True)
+    model_name = models.CharField(max_length=100, blank=True)
+    extra = models.TextField(blank=True) # json of any other form fields
+    adf_xml = models.TextField()
+
+    objects = LeadManager()
+
+    class Meta:
+        index_together = [('form_type', 'created')]
+
+    def __str__(self):
+        return self.form_type + ' ' + self.first_name + ' ' + self.last_name
+
+    # params:
+    # 1. cleaned_data: <Dict> of a valid lead form
+    # returns:
+    # <Dict> of json serializable Lead field values
+    @classmethod
+    def fields_from_cleaned_data(cls, cleaned_data):
+        fields = {}
+        extra = {}
+        for key, val in cleaned_data.items():
+            if key == 'stock_entry':
+                continue
+            elif key in ('make', 'model'):
+                fields[key + '_name'] = val.name
+            elif key in cls.DIRECT_FIELDS:
+                fields[key] = val
+            else:
+                extra[key] = str(val)
+        if fields.get('email'):
+            fields['email'] = fields['email'].lower()
+        fields['extra'] = json.dumps(extra, sort_keys=True)
+        return fields
+
+# params:
+# 1. batch_size: <Int>
+# returns:
+# <Int> number of queued leads copied into the Lead table
+def record_outbox_leads(batch_size=LEAD_OUTBOX_BATCH_SIZE):
+    batch = list(LeadOutbox.objects.filter(lead_recorded=False).order_by('id')[:batch_size])
+    if not batch:
+        return 0
+    with transaction.atomic():
+        # a row another worker flipped first matches nothing here
+        claimed = [
+            queued for queued in batch
+            if LeadOutbox.objects.filter(pk=queued.pk, lead_recorded=False).update(lead_recorded=True)
+        ]
+        Lead.objects.bulk_create([
+            Lead(form_type=queued.form_type, created=queued.created,
+                    adf_xml=queued.body, **json.loads(queued.lead_data))
+            for queued in claimed if queued.lead_data
+        ])
+    return len(claimed)
+
+# params:
+# 1. batch_size: <Int>
+# returns:
+# <List> of due <LeadOutbox> rows this worker now holds a lease on
+def claim_due_leads(batch_size=LEAD_OUTBOX_BATCH_SIZE):
+    claimed = []
+    for lead in LeadOutbox.objects.due()[:batch_size]:
+        lease = now() + timedelta(seconds=LEAD_OUTBOX_LEASE)
+        # only the worker whose update still sees the old value gets the lead;
+        # if it dies, the lead comes due again when the lease runs out
+        if LeadOutbox.objects.filter(pk=lead.pk, sent_at__isnull=True,
+                next_attempt_at=lead.next_attempt_at).update(next_attempt_at=lease):
+            lead.next_attempt_at = lease
+            claimed.append(lead)
+    return claimed
+
+# params:
+# 1. batch_size: <Int> leads sent over one SMTP connection
+# returns:
+# <Int> number of leads delivered
+def drain_lead_outbox(batch_size=LEAD_OUTBOX_BATCH_SIZE):
+    record_outbox_leads(batch_size)
+    batch = claim_due_leads(batch_size)
+    if not batch:
+        return 0
+    sent = 0
+    connection = get_connection(fail_silently=False)
+    try:
+        connection.open()
+    except Exception as e:
+        # the mail server is unreachable; every claimed lead backs off
+        for lead in batch:
+            lead.record_failure(e)
+        return 0
+    try:
+        for lead in batch:
+            try:
+                lead.as_email(connection).send()
+            except Exception as e:
+                lead.record_failure(e)
+            else:
+                lead.attempts += 1
+                lead.sent_at = now()
+                lead.save(update_fields=['attempts', 'sent_at'])
+                sent += 1
+    finally:
+        connection.close()
+    return sent
+
+# params:
+# 1. poll_interval: <Int> seconds to sleep while the outbox is empty
+# 2. max_backoff: <Int> longest sleep after repeated errors
+# Runs forever; meant for dedicated worker processes, any number of which
+# can run side by side since leads are claimed before they are sent.
+def run_lead_outbox_worker(poll_interval=5, batch_size=LEAD_OUTBOX_BATCH_SIZE,
+        max_backoff=300):
+    delay = poll_interval
+    while True:
+        try:
+            busy = drain_lead_outbox(batch_size) or record_outbox_leads(batch_size)
+        except Exception as e:
+            print('Lead outbox worker error: ' + repr(e))
+            time.sleep(delay)
+            delay = min(delay * 2, max_backoff)
+            continue
+        delay = poll_interval
+        if not busy:
+            time.sleep(poll_interval)
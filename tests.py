@@ -0,0 +1,24 @@
+from django.test import TestCase
+
+from .benchmarks import (check_listing_queries, check_vehicle_query_plans,
+        seed_inventory)
+
+# vehicles seeded for the query plan checks; enough that the planner
+# prefers an index over a scan wherever one is worth having
+QUERY_PLAN_INVENTORY_SIZE = 20000
+
+class VehicleQueryPlanTests(TestCase):
+    """
+    Fails when a vehicle lookup stops using its index or starts running
+    extra queries, e.g. after a model or manager change.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_inventory(QUERY_PLAN_INVENTORY_SIZE)
+
+    def test_vehicle_lookups_use_their_indexes(self):
+        self.assertEqual(check_vehicle_query_plans(), [])
+
+    def test_listing_pages_run_no_extra_queries(self):
+        self.assertEqual(check_listing_queries(), [])
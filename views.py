@@ -6,6 +6,8 @@ from django.views.generic import FormView
 from django.http import HttpResponseRedirect, HttpResponse, HttpResponseNotFound
 from django.core.mail import send_mail
 from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
 from django.core.mail import EmailMultiAlternatives
 from django.contrib import messages
 from .forms import *
@@ -13,8 +15,18 @@ from lxml import etree
 import ipdb
 from string import ascii_letters, digits
 from random import sample
+import gzip
+import hashlib
 import json
-from twilio.rest import TwilioRestClient
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
+from io import StringIO
+from time import monotonic
+from .clients import get_sms
+from .instrumentation import incr, timer
 
 def get_contact_node(first_name="", last_name="", phone="",
         email="", address="", city="", state="",
@@ -90,13 +102,204 @@ def get_vendor_node():
     vendor_node.append(contact_node)
     return vendor_node
 
-def get_requestdate_node():
-    ts = now().replace(microsecond=0)
+def get_requestdate_node(ts=None):
+    if ts is None:
+        ts = now()
+    ts = ts.replace(microsecond=0)
     # request timestamp
     requestdate_node = etree.Element("requestdate")
     requestdate_node.text = ts.isoformat()
     return requestdate_node
 
+ADF_XML_DECL = """<?xml version="1.0" encoding="UTF-8"?><?adf version="1.0"?>"""
+
+def node_xml(node):
+    return etree.tostring(node, encoding='unicode')
+
+@lru_cache()
+def get_constant_prospect_xml():
+    """
+        The provider and vendor nodes are the same for every lead, so they
+        are serialized once per process
+    """
+    return node_xml(get_provider_node()) + node_xml(get_vendor_node())
+
+def write_prospect(out, prospect_node, requestdate_node=None):
+    """
+        Writes a <prospect> to the text stream out. Only the request date
+        and the lead specific children of prospect_node are serialized,
+        the output is the same as serializing the complete tree.
+    """
+    if requestdate_node is None:
+        requestdate_node = get_requestdate_node()
+    out.write("<prospect>")
+    out.write(node_xml(requestdate_node))
+    out.write(get_constant_prospect_xml())
+    for node in prospect_node:
+        out.write(node_xml(node))
+    out.write("</prospect>")
+
+def get_prospect_xml(view, form, requestdate=None):
+    """
+        Serialized <prospect> for form as the given ADFFormView would send
+        it, with requestdate (a datetime) in place of the current time
+    """
+    out = StringIO()
+    requestdate_node = None if requestdate is None else get_requestdate_node(requestdate)
+    write_prospect(out, view.adfxml(form, etree.Element("prospect")), requestdate_node)
+    return out.getvalue()
+
+def iter_stored_prospects(queryset=None, field='adf_xml'):
+    """
+        Yields the <prospect> of every stored lead without loading the
+        whole queryset into memory. Reads Lead by default; pass a
+        LeadOutbox queryset with field='body' for leads not recorded yet.
+    """
+    if queryset is None:
+        queryset = Lead.objects.order_by('id')
+    for body in queryset.values_list(field, flat=True).iterator():
+        start = body.find("<prospect>")
+        end = body.rfind("</prospect>")
+        if start != -1 and end != -1:
+            yield body[start:end + len("</prospect>")]
+
+def iter_outbox_prospects(queryset=None):
+    if queryset is None:
+        queryset = LeadOutbox.objects.order_by('id')
+    return iter_stored_prospects(queryset, field='body')
+
+def export_adf(out, prospects):
+    """
+        Writes one ADF document holding every serialized <prospect> in
+        prospects to the text stream out, one prospect at a time.
+        Returns the number of prospects written.
+    """
+    count = 0
+    out.write(ADF_XML_DECL)
+    out.write("<adf>")
+    for prospect_xml in prospects:
+        out.write(prospect_xml)
+        count += 1
+    out.write("</adf>")
+    return count
+
+def export_adf_file(path, prospects):
+    """
+        export_adf to a file, gzip compressed when path ends in .gz
+    """
+    if path.endswith('.gz'):
+        out = gzip.open(path, 'wt', encoding='utf-8')
+    else:
+        out = open(path, 'w', encoding='utf-8')
+    with out:
+        return export_adf(out, prospects)
+
+class LeadDeduplicator(object):
+    """
+    Remembers the leads delivered in the last `window` seconds so that
+    double submits and replayed forms are dropped instead of reaching the
+    CRM twice. A lead is identified by its form type, the digits of the
+    phone number, the lowercased email and the stock number (or VIN).
+
+    Keys live in an insertion ordered dict, so expiry and the max_size
+    bound only ever pop from the front. Given a Django cache, cache.add
+    is used instead and the window is shared by every worker using it.
+    """
+
+    def __init__(self, window=600, max_size=10000, cache=None):
+        self.window = window
+        self.max_size = max_size
+        self.cache = cache
+        self.seen = OrderedDict()
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def key(self, lead_type, cleaned_data):
+        phone = ''.join(c for c in cleaned_data.get('phone') or '' if c.isdigit())
+        email = (cleaned_data.get('email') or '').strip().lower()
+        vehicle = cleaned_data.get('stock_number') or cleaned_data.get('vin') or ''
+        raw = '|'.join([lead_type, phone, email, vehicle])
+        return 'adf-lead:' + hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def is_duplicate(self, lead_type, cleaned_data):
+        key = self.key(lead_type, cleaned_data)
+        if self.cache is not None:
+            duplicate = not self.cache.add(key, 1, self.window)
+        else:
+            duplicate = self.check_and_remember(key)
+        if duplicate:
+            with self.lock:
+                self.dropped += 1
+            if self.cache is not None:
+                self.incr_shared('adf-lead:dropped')
+        return duplicate
+
+    def forget(self, lead_type, cleaned_data):
+        # the lead was never stored, so a retry must get through
+        key = self.key(lead_type, cleaned_data)
+        if self.cache is not None:
+            self.cache.delete(key)
+        else:
+            with self.lock:
+                self.seen.pop(key, None)
+
+    def check_and_remember(self, key):
+        current = monotonic()
+        with self.lock:
+            while self.seen:
+                oldest = next(iter(self.seen))
+                if current - self.seen[oldest] < self.window:
+                    break
+                self.seen.popitem(last=False)
+            if key in self.seen:
+                return True
+            self.seen[key] = current
+            if len(self.seen) > self.max_size:
+                self.seen.popitem(last=False)
+            return False
+
+    def incr_shared(self, key):
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            # first drop since the counter expired from the cache
+            self.cache.add(key, 1, None)
+
+    def metrics(self):
+        metrics = {'dropped': self.dropped, 'tracked': len(self.seen)}
+        if self.cache is not None:
+            metrics['dropped_shared'] = self.cache.get('adf-lead:dropped', 0)
+        return metrics
+
+def get_lead_deduplicator():
+    """
+        Configured through ADF_LEAD_DEDUPE_WINDOW (seconds) and
+        ADF_LEAD_DEDUPE_CACHE, the alias of a cache to share the window
+        through; without one the window is per process
+    """
+    alias = getattr(settings, 'ADF_LEAD_DEDUPE_CACHE', None)
+    return LeadDeduplicator(
+        window=getattr(settings, 'ADF_LEAD_DEDUPE_WINDOW', 600),
+        cache=caches[alias] if alias else None,
+    )
+
+lead_deduplicator = get_lead_deduplicator()
+
+logger = logging.getLogger(__name__)
+
+# shared by every view that does slow outbound work off the request thread
+lead_executor = ThreadPoolExecutor(max_workers=getattr(settings, 'ADF_LEAD_THREADS', 8))
+
+def run_in_thread(func, *args):
+    """
+        Calls func on an executor thread and closes the database connection
+        Django opened for that thread, which would otherwise leak
+    """
+    try:
+        return func(*args)
+    finally:
+        connection.close()
+
 class ADFFormView(FormView):
     """
     Must implement adfxml which is called when the form is valid
@@ -106,33 +309,79 @@ class ADFFormView(FormView):
         # all new data are 'append'ed
         returns prospect_node
         ...
+
+    With use_outbox set, the lead is stored in LeadOutbox and mailed by
+    run_lead_outbox_worker instead of inside the request. Repeats of a
+    lead inside the deduplicator's window are dropped.
     """
 
     to_email = "leads@example.com"
     subject_line = "Acura - Contact Request"
+    lead_type = "contact"
+    use_outbox = True
+    deduplicator = lead_deduplicator
 
     def adfxml(self, form, prospect_node):
         raise ImproperlyConfigured('adfxml method not implemented to populate prospect_node.')
 
-    def mail_adfxml(self, form):
-        xml_decl = """<?xml version="1.0" encoding="UTF-8"?><?adf version="1.0"?>"""
-        adf_node = etree.Element("adf")
+    def build_adfxml(self, form):
+        with timer('lead_adfxml_build_seconds'):
+            prospect_node = self.adfxml(form, etree.Element("prospect"))
+        with timer('lead_adfxml_serialize_seconds'):
+            out = StringIO()
+            out.write(ADF_XML_DECL)
+            out.write("<adf>")
+            write_prospect(out, prospect_node)
+            out.write("</adf>")
+            return out.getvalue()
 
-        prospect_node = etree.Element("prospect")
-        prospect_node.append(get_requestdate_node())
-        prospect_node.append(get_provider_node())
-        prospect_node.append(get_vendor_node())
-
-        prospect_node = self.adfxml(form, prospect_node)
-        adf_node.append(prospect_node)
+    def mail_adfxml(self, form):
+        if self.deduplicator is not None and self.deduplicator.is_duplicate(
+                self.lead_type, form.cleaned_data):
+            incr('lead_duplicates_total')
+            return
+        incr('leads_total')
+        try:
+            total_xml = self.deliver_adfxml(form)
+        except Exception:
+            # nothing was stored or sent, so the shopper's retry isn't a duplicate
+            if self.deduplicator is not None:
+                self.deduplicator.forget(self.lead_type, form.cleaned_data)
+            raise
+        if not self.use_outbox:
+            lead_fields = Lead.fields_from_cleaned_data(form.cleaned_data)
+            Lead.objects.create(form_type=self.lead_type, adf_xml=total_xml, **lead_fields)
+
+    def deliver_adfxml(self, form):
+        # stores the lead in the outbox, or mails it without one
+        total_xml = self.build_adfxml(form)
         if settings.DEBUG:
+            adf_node = etree.fromstring(total_xml.encode('utf-8'))
             print(etree.tostring(adf_node, encoding='unicode', pretty_print=True))
-        total_xml = xml_decl + etree.tostring(adf_node, encoding='unicode')
 
         """ mail the xml to self.to_email now """
         subject, from_email, to = self.subject_line, settings.DEFAULT_FROM_EMAIL, self.to_email
         text_content = total_xml
-        send_mail(subject, text_content, from_email, [to], fail_silently=False)
+        if self.use_outbox:
+            # the worker copies the lead into the Lead table off the request
+            lead_fields = Lead.fields_from_cleaned_data(form.cleaned_data)
+            with timer('lead_outbox_write_seconds'):
+                LeadOutbox.objects.create(subject=subject, body=text_content,
+                        from_email=from_email, to_email=to,
+                        form_type=self.lead_type, lead_data=json.dumps(lead_fields))
+        else:
+            with timer('lead_send_mail_seconds'):
+                send_mail(subject, text_content, from_email, [to], fail_silently=False)
+        return total_xml
+
+    def post(self, request, *args, **kwargs):
+        # FormView.post with the form's validation timed
+        form = self.get_form(self.get_form_class())
+        with timer('lead_form_clean_seconds'):
+            is_valid = form.is_valid()
+        if is_valid:
+            return self.form_valid(form)
+        return self.form_invalid(form)
 
     def form_valid(self, form):
         self.mail_adfxml(form)
@@ -144,6 +393,7 @@ class ContactFormView(ADFFormView):
     success_url = reverse_lazy('contact-thankyou')
     to_email = "leads@example.com"
     subject_line = "Montclair Acura - Contact Request"
+    lead_type = "contact"
 
     def adfxml(self, form, prospect_node):
 
@@ -228,6 +478,7 @@ class TestDriveFormView(ADFFormView):
     success_url = reverse_lazy('testdrive')
     to_email = "leads@example.com"
     subject_line = "Montclair Acura - Test Drive Request"
+    lead_type = "test-drive"
 
     def form_valid(self, form):
         self.mail_adfxml(form)
@@ -243,7 +494,7 @@ class TestDriveFormView(ADFFormView):
         slot_description = form.cleaned_data["scheduled_slot"] + " on " + schedule_date.strftime("%A %b %d, %Y")
 
         comments_node = etree.Element("comments")
-        comments_node = "Test Drive requested between" + slot_description + "\n" + form.cleaned_data['message']
+        comments_node.text = "Test Drive requested between " + slot_description + "\n" + form.cleaned_data['message']
 
         customer_node.append(comments_node)
 
@@ -263,6 +514,7 @@ class RequestQuoteFormView(ADFFormView):
     success_url = reverse_lazy('requestquote')
     to_email = "leads@example.com"
     subject_line = "Montclair Acura - Request for Quotation"
+    lead_type = "quote"
 
     def form_valid(self, form):
         self.mail_adfxml(form)
@@ -288,6 +540,7 @@ class RequestInfoFormView(ADFFormView):
     success_url = reverse_lazy('requestinfo')
     to_email = "leads@example.com"
     subject_line = "Montclair Acura - Request for Information"
+    lead_type = "info"
 
     def form_valid(self, form):
         self.mail_adfxml(form)
@@ -313,6 +566,7 @@ class ConfirmAvailabilityFormView(ADFFormView):
     success_url = reverse_lazy('confirmavailability')
     to_email = "leads@example.com"
     subject_line = "Montclair Acura - Confirm Availability"
+    lead_type = "availability"
 
     def form_valid(self, form):
         self.mail_adfxml(form)
@@ -338,6 +592,7 @@ class VehicleFinanceFormView(ADFFormView):
     success_url = reverse_lazy('confirmavailability')
     to_email = "leads@example.com"
     subject_line = "Montclair Acura - Enquiry about Finance"
+    lead_type = "finance"
 
     def form_valid(self, form):
         self.mail_adfxml(form)
@@ -363,6 +618,10 @@ class SendToMobileFormView(ADFFormView):
     success_url = reverse_lazy('sendtomobile')
     to_email = "leads@example.com"
     subject_line = "Montclair Acura - Lead via Send To Mobile"
+    lead_type = "send-to-mobile"
+    executor = lead_executor
+    # seconds the response waits for the sms and the lead
+    fanout_timeout = 5
 
     def adfxml(self, form, prospect_node):
 
@@ -383,14 +642,38 @@ class SendToMobileFormView(ADFFormView):
         prospect_node.append(customer_node)
         return prospect_node
 
+    def get_sms_client(self):
+        return get_sms()
+
+    def send_vehicle_sms(self, entry, phone):
+        # the StockEntry the form validated against, so a rebuilt index
+        # can't lose the vehicle between validation and this thread
+        vehicle = entry.vehicle()
+        with timer('sms_shortener_seconds'):
+            short_link = vehicle.get_shortened_url()
+        with timer('sms_twilio_seconds'):
+            return self.get_sms_client().send(
+                to='+1 ' + phone,
+                body="Link to the vehicle "+ short_link
+            )
+
+    def send_vehicle_sms_or_log(self, entry, phone):
+        # a failed sms must not fail the request, the lead is already stored
+        try:
+            return self.send_vehicle_sms(entry, phone)
+        except Exception:
+            incr('sms_failures_total')
+            logger.exception('Could not send the vehicle link for %s', entry.stock_number)
+
     def form_valid(self, form):
-        vehicle = Vehicle.objects.get(stock_number=form.cleaned_data['stock_number'])
-        short_link = vehicle.get_shortened_url()
-        twilio_client = TwilioRestClient(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
-        msg = twilio_client.messages.create(
-            to='+1 ' + form.cleaned_data['phone'],
-            from_=settings.TWILIO_NUMBER,
-            body="Link to the vehicle "+ short_link
-        )
+        # the sms goes out on an executor thread while the lead is stored
+        # here, so it is durable before the response; the response only
+        # waits fanout_timeout for the sms
+        sms = self.executor.submit(run_in_thread, self.send_vehicle_sms_or_log,
+                form.cleaned_data['stock_entry'], form.cleaned_data['phone'])
         self.mail_adfxml(form)
+        with timer('sms_fanout_seconds'):
+            done, not_done = wait([sms], timeout=self.fanout_timeout)
+        if not_done:
+            incr('sms_fanout_timeouts_total')
         return HttpResponse("<h2>Thank you! You should receive the link on your phone shortly.</h2>")